@@ -0,0 +1,373 @@
+"""
+Parse rotated and live logs without parsing any content twice.
+
+    ledger = ProcessedLedger('/var/lib/datadog-parsers/ledger.json')
+    for path in ['access.log.2.gz', 'access.log.1', 'access.log']:
+        for metric in ledger.parse_file(path, nginx.timings.parse_logs, logger):
+            submit(metric)
+
+Files are identified by a fingerprint of their first block of (decompressed)
+content rather than by name, so ``access.log`` renamed to ``access.log.1`` and
+later compressed to ``access.log.2.gz`` is still recognised. For each file the
+ledger records how many bytes have been processed and a hash of the last line,
+and resumes from there.
+
+Several processes can share one ledger path, e.g. a backfill and the live
+ingestion (``ingestion.LogSource`` with ``ledger=``). Lines are claimed in
+chunks: the ledger is locked just long enough to merge the progress on disk,
+record the chunk and write it back, and parsing happens without the lock. A
+range claimed by one process is skipped by the others. When a file's content
+changes behind its offset the file is read again from the start, and that
+reset wins over older progress held by other processes. If a process dies
+mid-chunk, the rest of that chunk is not parsed.
+
+Where files overlap at their edges (e.g. lines written between the copy and
+the truncate of ``copytruncate``), the first ``edge_lines`` lines of every file
+are checked against the first and last ``edge_lines`` lines of the files seen
+before it. These edges are kept with each file's entry and moved into a
+Bloom filter once they can no longer match the file itself: the head once it
+is complete, the tail when the next new file is first seen. The filter has a
+fixed size and two generations, so memory stays bounded (about 260 KB per
+generation with the defaults). Each generation is sized so that, with both
+full, about ``false_positive_rate`` of the checked lines are wrongly dropped:
+0.01% by default, or about 0.1 of the first 1000 lines of each new file.
+Genuinely identical lines at the start of a new file are also dropped.
+"""
+import base64
+import contextlib
+import copy
+import fcntl
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+
+FINGERPRINT_BYTES = 4096
+DEFAULT_EDGE_LINES = 1000
+DEFAULT_CHUNK_LINES = 1000
+DEFAULT_BLOOM_CAPACITY = 100000
+DEFAULT_FALSE_POSITIVE_RATE = 0.0001
+MAX_FILES = 1000
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class BloomFilter(object):
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray(num_bits // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        """A filter that has ``false_positive_rate`` once ``capacity`` items are added"""
+        num_bits = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        num_bits += -num_bits % 8
+        num_hashes = max(int(round(float(num_bits) / capacity * math.log(2))), 1)
+        return cls(num_bits, num_hashes)
+
+    def add(self, line_hash):
+        for position in self._positions(line_hash):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, line_hash):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(line_hash))
+
+    def to_json(self):
+        return {
+            'bits': base64.b64encode(bytes(self.bits)).decode('ascii'),
+            'num_hashes': self.num_hashes,
+            'count': self.count,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        bits = bytearray(base64.b64decode(data['bits']))
+        return cls(len(bits) * 8, data['num_hashes'], bits, data['count'])
+
+    def _positions(self, line_hash):
+        # enhanced double hashing over two halves of the line digest; the growing
+        # step avoids the short cycles of plain h1 + i * h2 when h2 shares a factor with num_bits
+        value = int(line_hash, 16)
+        position = (value & 0xffffffffffffffff) % self.num_bits
+        step = (value >> 64) % self.num_bits
+        positions = []
+        for i in range(self.num_hashes):
+            positions.append(position)
+            position = (position + step) % self.num_bits
+            step = (step + i + 1) % self.num_bits
+        return positions
+
+
+class ProcessedLedger(object):
+    def __init__(self, path, edge_lines=DEFAULT_EDGE_LINES, bloom_capacity=DEFAULT_BLOOM_CAPACITY,
+                 false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, chunk_lines=DEFAULT_CHUNK_LINES):
+        self.path = path
+        self.edge_lines = edge_lines
+        self.bloom_capacity = bloom_capacity
+        # both generations are checked, so each gets half of the allowed rate
+        self.generation_false_positive_rate = false_positive_rate / 2
+        self.chunk_lines = chunk_lines
+        self.files = {}
+        self.bloom = self._new_bloom()
+        self.previous_bloom = None
+        # (inode, mtime, size) of the ledger file last read or written
+        self._loaded = None
+        self._merge_from_disk()
+
+    def parse_file(self, log_path, parse_func, logger):
+        """Yield the metrics of every line of ``log_path`` that has not been processed before"""
+        lines = self.new_lines(log_path)
+        try:
+            for line in lines:
+                result = parse_func(logger, line)
+                if not result:
+                    continue
+                if isinstance(result, tuple):
+                    yield result
+                else:
+                    for metric in result:
+                        yield metric
+        finally:
+            lines.close()
+
+    def new_lines(self, log_path, max_lines=None):
+        """
+        Yield the complete lines of ``log_path`` that have not been processed before.
+
+        Lines are claimed ``chunk_lines`` at a time: the ledger is locked only to
+        merge the progress on disk, record the chunk as processed and write it
+        back, so other processes sharing the ledger skip it. If the generator is
+        closed part way through a chunk, the rest of the chunk is handed back
+        unless another process has already claimed lines after it.
+
+        Stops after ``max_lines`` lines if given. A trailing line without a
+        newline is left for the next run.
+        """
+        with _open_log(log_path) as f:
+            head = f.read(FINGERPRINT_BYTES)
+            fingerprint = _digest(head)
+            remaining = max_lines
+            while head and remaining != 0:
+                limit = self.chunk_lines if remaining is None else min(self.chunk_lines, remaining)
+                with self._lock():
+                    self._merge_from_disk()
+                    start, records = self._claim(f, head, limit)
+                    claimed = _version(self.files[fingerprint])
+                    self._write()
+                if not records:
+                    return
+
+                consumed = 0
+                try:
+                    for line_hash, length, line in records:
+                        consumed += 1
+                        if line is not None:
+                            yield line
+                finally:
+                    if consumed < len(records):
+                        with self._lock():
+                            self._merge_from_disk()
+                            self._give_back(fingerprint, start, claimed, records[:consumed])
+                            self._write()
+                if remaining is not None:
+                    remaining -= len(records)
+
+    def processed_bytes(self, log_path):
+        """How many bytes of (decompressed) ``log_path`` have been processed"""
+        with _open_log(log_path) as f:
+            head = f.read(FINGERPRINT_BYTES)
+        with self._lock():
+            self._merge_from_disk()
+        entry = self._find_entry(head) if head else None
+        return entry['offset'] if entry else 0
+
+    def save(self):
+        """Merge this ledger's progress with the one on disk and write it"""
+        with self._lock():
+            self._merge_from_disk()
+            self._write()
+
+    def _claim(self, f, head, limit):
+        """
+        Read up to ``limit`` lines from where the file was left and record them as
+        processed. Returns the entry as it was before, and ``(line_hash, length,
+        line)`` for each line, with ``line`` None for lines seen at another file's edge.
+        """
+        entry = self._get_entry(head)
+        if entry['offset']:
+            f.seek(entry['offset'] - entry['tail_length'])
+            if _digest(f.readline()) != entry['tail_hash']:
+                # content behind the recorded offset changed: treat it as a new file
+                self._fold_edges(entry, entry['head_edges'])
+                entry.update(offset=0, line_count=0, tail_hash=None, tail_length=0,
+                             generation=entry['generation'] + 1)
+        if not entry['offset']:
+            f.seek(0)
+        if not entry['line_count']:
+            # the start of a new file is checked against the ends of the others
+            for other in self.files.values():
+                self._fold_edges(other, other['tail_edges'])
+
+        start = copy.deepcopy(entry)
+        records = []
+        for raw_line in iter(f.readline, b''):
+            if not raw_line.endswith(b'\n'):
+                break
+            line_hash = _digest(raw_line)
+            line = None
+            if entry['line_count'] >= self.edge_lines or not self._seen_edge(line_hash):
+                line = raw_line.rstrip(b'\r\n')
+                if not isinstance(line, str):
+                    line = line.decode('utf-8', 'replace')
+            self._advance(entry, line_hash, len(raw_line))
+            records.append((line_hash, len(raw_line), line))
+            if len(records) >= limit:
+                break
+
+        if entry['line_count'] >= self.edge_lines:
+            # the whole head has been checked, so it cannot match the file itself any more
+            self._fold_edges(entry, entry['head_edges'])
+        return start, records
+
+    def _give_back(self, fingerprint, start, claimed, consumed):
+        """Rewind a claimed chunk to just after the ``consumed`` records, unless it moved on since"""
+        entry = self.files.get(fingerprint)
+        if entry is None or _version(entry) != claimed:
+            return
+        for line_hash, length, line in consumed:
+            self._advance(start, line_hash, length)
+        self.files[fingerprint] = start
+
+    def _advance(self, entry, line_hash, length):
+        entry['offset'] += length
+        entry['tail_hash'] = line_hash
+        entry['tail_length'] = length
+        entry['updated'] = time.time()
+        if entry['line_count'] < self.edge_lines:
+            entry['head_edges'].append(line_hash)
+        entry['line_count'] += 1
+        tail_edges = entry['tail_edges']
+        tail_edges.append(line_hash)
+        if len(tail_edges) > 2 * self.edge_lines:
+            del tail_edges[:-self.edge_lines]
+
+    def _fold_edges(self, entry, edges):
+        """Move an entry's recorded ``edges`` into the Bloom filter"""
+        for line_hash in set(edges[-self.edge_lines:]):
+            self._add_edge(line_hash)
+        del edges[:]
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open('{}.lock'.format(self.path), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _merge_from_disk(self):
+        """
+        Take the latest entry per file from disk and this ledger, and the Bloom
+        filter from disk. Entries reset by a content change win over older ones
+        whatever their offset.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self._loaded:
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+
+        for fingerprint, entry in data['files'].items():
+            current = self.files.get(fingerprint)
+            if current is None or _version(entry) >= _version(current):
+                self.files[fingerprint] = entry
+
+        self.bloom = BloomFilter.from_json(data['bloom'])
+        self.previous_bloom = BloomFilter.from_json(data['previous_bloom']) if data.get('previous_bloom') else None
+        self._loaded = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _write(self):
+        """Call with the lock held, after merging"""
+        data = {
+            'files': self.files,
+            'bloom': self.bloom.to_json(),
+            'previous_bloom': self.previous_bloom.to_json() if self.previous_bloom else None,
+        }
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+        stat = os.stat(self.path)
+        self._loaded = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def _get_entry(self, head):
+        fingerprint = _digest(head)
+        entry = self._find_entry(head)
+        if entry is None:
+            entry = {
+                'offset': 0,
+                'line_count': 0,
+                'tail_hash': None,
+                'tail_length': 0,
+                'generation': 0,
+                'head_edges': [],
+                'tail_edges': [],
+            }
+            self._prune()
+        # a file shorter than one block gets a new fingerprint as it grows
+        self.files.pop(entry.get('fingerprint'), None)
+        entry.update(fingerprint=fingerprint, length=len(head), updated=time.time())
+        self.files[fingerprint] = entry
+        return entry
+
+    def _find_entry(self, head):
+        entry = self.files.get(_digest(head))
+        if entry is not None:
+            return entry
+        for fingerprint, entry in self.files.items():
+            if entry['length'] < len(head) and _digest(head[:entry['length']]) == fingerprint:
+                return entry
+        return None
+
+    def _prune(self):
+        if len(self.files) >= MAX_FILES:
+            oldest = sorted(self.files, key=lambda fingerprint: self.files[fingerprint]['updated'])
+            for fingerprint in oldest[:len(self.files) - MAX_FILES + 1]:
+                del self.files[fingerprint]
+
+    def _seen_edge(self, line_hash):
+        return line_hash in self.bloom or (self.previous_bloom is not None and line_hash in self.previous_bloom)
+
+    def _add_edge(self, line_hash):
+        if self.bloom.count >= self.bloom_capacity:
+            self.previous_bloom = self.bloom
+            self.bloom = self._new_bloom()
+        self.bloom.add(line_hash)
+
+    def _new_bloom(self):
+        return BloomFilter.for_capacity(self.bloom_capacity, self.generation_false_positive_rate)
+
+
+def _open_log(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _digest(line):
+    return hashlib.sha1(line).hexdigest()
+
+
+def _version(entry):
+    # a reset (content changed behind the offset) starts a new generation
+    return entry['generation'], entry['offset']
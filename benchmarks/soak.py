@@ -0,0 +1,260 @@
+"""
+Long-running replay of logs through the parsers to catch drift over time.
+
+    python benchmarks/soak.py --duration 600 --speedup 50 --log nginx=/var/log/nginx/access.log
+
+Recorded logs are replayed in a loop; sources without a recorded log get
+synthetic lines with ever-new domains and ids, so new URL shapes keep
+appearing. Replay is paced so log time advances ``speedup`` times faster
+than wall time (``--speedup 0`` replays as fast as possible). Each source is
+paced against its own log clock, which restarts whenever a recorded log
+wraps around, so sources from different periods can be mixed.
+
+Every ``--sample-interval`` seconds the harness records RSS, lines/sec,
+mean parse latency, log records emitted per line and the top allocators
+(tracemalloc on Python 3, live objects by type otherwise). The run fails
+if RSS, latency or log volume drift past the thresholds between the first
+sample after warm-up and the last one.
+"""
+import argparse
+import collections
+import gc
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+
+try:
+    from couch.parsers import parse_couch_logs
+except ImportError:
+    # run from a checkout without the package installed
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from couch.parsers import parse_couch_logs
+from nginx.errors import parse_nginx_errors
+from nginx.timings import parse_logs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PARSERS = {
+    'nginx': parse_logs,
+    'nginx_errors': parse_nginx_errors,
+    'couch': parse_couch_logs,
+}
+
+Sample = collections.namedtuple('Sample', 'elapsed, rss_bytes, lines, lines_per_second, mean_latency, log_records, top_allocators')
+
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, level=logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def synthetic_lines(source, log_rate=1000, garbage_ratio=0.001, seed=0):
+    """Yield an endless stream of ``source`` log lines, ``log_rate`` per second of log time"""
+    rng = random.Random(seed)
+    start = 1446045494
+    for i in itertools.count():
+        timestamp = start + i // log_rate
+        if rng.random() < garbage_ratio:
+            yield 'garbage line {}'.format(i)
+            continue
+        domain = 'project-{}'.format(rng.randint(0, i // 10 + 10))
+        doc_id = '%032x' % rng.getrandbits(128)
+        if source == 'nginx':
+            yield '[{}] GET /a/{}/{}/{}/modules-{}/ HTTP/1.1 {} {:.3f} -'.format(
+                time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(timestamp)),
+                domain, rng.choice(['api', 'receiver', 'apps', 'phone']), doc_id, rng.randint(0, 20),
+                rng.choice([200, 200, 200, 302, 404, 500]), rng.expovariate(2),
+            )
+        elif source == 'nginx_errors':
+            yield '{} [error] 1#1: *{} connect() failed (111: Connection refused) while connecting to upstream'.format(
+                time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(timestamp)), i,
+            )
+        else:
+            yield '{},000 [:{}] /a/{}/receiver/{}/ corehq.apps.tasks.task_{} commcarehq GET 200 None /commcarehq/{} 0:00:{:09.6f}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)),
+                domain, domain, doc_id, rng.randint(0, 50), doc_id, rng.expovariate(10),
+            )
+
+
+def recorded_lines(path):
+    """Yield the lines of ``path`` over and over"""
+    while True:
+        with open(path) as f:
+            for line in f:
+                yield line.rstrip('\r\n')
+
+
+def get_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        # peak rather than current RSS, but still shows growth
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def get_top_allocators(limit=5):
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+        return [(str(stat.traceback), stat.size) for stat in stats]
+    counts = collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+    return counts.most_common(limit)
+
+
+def run_soak(streams, duration, speedup=0, sample_interval=10, clock=time.time, sleep=time.sleep):
+    """
+    Round-robin lines from ``streams`` (source name -> line iterator) through
+    their parsers for ``duration`` seconds and return a list of ``Sample``.
+    """
+    logger = logging.getLogger('soak')
+    counter = CountingHandler()
+    root = logging.getLogger()
+    saved_handlers = root.handlers[:]
+    root.handlers = [counter]
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    samples = []
+    try:
+        start = clock()
+        interval_start = start
+        interval_lines = 0
+        interval_parse_time = 0
+        interval_log_records = 0
+        total_lines = 0
+        # source name -> (log time, wall time) that pacing is measured from
+        origins = {}
+        last_log_times = {}
+        sources = [(name, PARSERS[name], iter(lines)) for name, lines in sorted(streams.items())]
+
+        while clock() - start < duration:
+            for name, parse_func, lines in sources:
+                line = next(lines)
+                before = clock()
+                result = parse_func(logger, line)
+                interval_parse_time += clock() - before
+                interval_lines += 1
+                total_lines += 1
+
+                log_time = _get_log_time(result)
+                if speedup and log_time is not None:
+                    now = clock()
+                    origin = origins.get(name)
+                    if origin is None or log_time < last_log_times[name]:
+                        # first line, or a recorded log starting again from the top
+                        origin = origins[name] = (log_time, now)
+                    last_log_times[name] = log_time
+                    ahead = (log_time - origin[0]) / float(speedup) - (now - origin[1])
+                    remaining = duration - (now - start)
+                    if ahead > 0 and remaining > 0:
+                        sleep(min(ahead, remaining))
+
+            now = clock()
+            if now - interval_start >= sample_interval:
+                log_records = counter.count - interval_log_records
+                interval_log_records = counter.count
+                samples.append(Sample(
+                    elapsed=now - start,
+                    rss_bytes=get_rss_bytes(),
+                    lines=total_lines,
+                    lines_per_second=interval_lines / (now - interval_start),
+                    mean_latency=interval_parse_time / interval_lines,
+                    log_records=float(log_records) / interval_lines,
+                    top_allocators=get_top_allocators(),
+                ))
+                interval_start = now
+                interval_lines = 0
+                interval_parse_time = 0
+    finally:
+        root.handlers = saved_handlers
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    return samples
+
+
+def check_drift(samples, warmup=1, max_rss_growth_mb=50, max_latency_growth=0.5, max_log_records_per_line=0.01):
+    """Return a description of every threshold exceeded between the first post-warmup sample and the last"""
+    if len(samples) <= warmup + 1:
+        return ['not enough samples ({}) to measure drift'.format(len(samples))]
+
+    baseline, last = samples[warmup], samples[-1]
+    failures = []
+    rss_growth_mb = (last.rss_bytes - baseline.rss_bytes) / (1024.0 * 1024)
+    if rss_growth_mb > max_rss_growth_mb:
+        failures.append('RSS grew by {:.1f} MB (limit {} MB)'.format(rss_growth_mb, max_rss_growth_mb))
+
+    latency_growth = last.mean_latency / baseline.mean_latency - 1
+    if latency_growth > max_latency_growth:
+        failures.append('mean parse latency grew by {:.0%} (limit {:.0%})'.format(latency_growth, max_latency_growth))
+
+    log_records = max(sample.log_records for sample in samples[warmup:])
+    if log_records > max_log_records_per_line:
+        failures.append('{:.3f} log records per line (limit {})'.format(log_records, max_log_records_per_line))
+
+    return failures
+
+
+def _get_log_time(result):
+    if not result:
+        return None
+    metric = result if isinstance(result, tuple) else result[0]
+    return metric[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=300, help='wall seconds to run for')
+    parser.add_argument('--speedup', type=float, default=0, help='log seconds replayed per wall second (0: unthrottled)')
+    parser.add_argument('--sample-interval', type=float, default=10)
+    parser.add_argument('--source', action='append', choices=sorted(PARSERS),
+                        help='sources to replay (default: all)')
+    parser.add_argument('--log', action='append', default=[], metavar='SOURCE=PATH',
+                        help='recorded log to replay for a source instead of synthetic lines')
+    parser.add_argument('--warmup', type=int, default=1, help='samples to ignore before the baseline')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=50)
+    parser.add_argument('--max-latency-growth', type=float, default=0.5)
+    parser.add_argument('--max-log-records-per-line', type=float, default=0.01)
+    args = parser.parse_args()
+
+    recorded = dict(option.split('=', 1) for option in args.log)
+    streams = {}
+    for source in args.source or sorted(PARSERS):
+        if source in recorded:
+            streams[source] = recorded_lines(recorded[source])
+        else:
+            streams[source] = synthetic_lines(source)
+
+    samples = run_soak(streams, args.duration, args.speedup, args.sample_interval)
+    print('{:>8} {:>10} {:>12} {:>14} {:>12}'.format('elapsed', 'rss (MB)', 'lines/sec', 'latency (us)', 'logs/line'))
+    for sample in samples:
+        print('{:>8.0f} {:>10.1f} {:>12.0f} {:>14.1f} {:>12.4f}'.format(
+            sample.elapsed, sample.rss_bytes / (1024.0 * 1024), sample.lines_per_second,
+            sample.mean_latency * 1e6, sample.log_records,
+        ))
+    if samples:
+        print('\ntop allocators at end:')
+        for where, size in samples[-1].top_allocators:
+            print('  {}: {}'.format(where, size))
+
+    failures = check_drift(samples, args.warmup, args.max_rss_growth_mb,
+                           args.max_latency_growth, args.max_log_records_per_line)
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Startup cost of the parser modules.
+
+Each measurement runs in a fresh interpreter so nothing is cached:
+
+    python benchmarks/startup.py [--runs N]
+
+Reports, for each parser module, the time to import its shared
+dependencies and the module itself separately, and the latency of parsing
+its first line (which includes compiling the regexes it uses). On
+Python 3.7+ the ``python -X importtime`` breakdown is printed as well.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_LINES = {
+    'nginx.timings': ('parse_logs', '[28/Oct/2015:15:18:14 +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 200 0.242 https://www.commcarehq.org/a/uth-rhd/'),
+    'nginx.errors': ('parse_nginx_errors', '2018/01/03 19:04:31 [error] 22548#22548: *16560854 connect() failed (111: Connection refused) while connecting to upstream'),
+    'couch.parsers': ('parse_couch_logs', '2017-05-04 12:20:21,416 [:icds-cas] /a/icds-cas/receiver/secure/768932dcb27f35c63cdbb830c202c727/ commcarehq__users GET 200 None _design/users/_view/by_username 0:00:00.004401'),
+}
+
+# imported first and timed on their own, so the module time is its own cost
+DEPENDENCIES = ('parsing_utils', 'streaming')
+
+MEASURE = """
+import importlib, logging, time
+timings = []
+for module in {modules!r}:
+    start = time.time()
+    importlib.import_module(module)
+    timings.append(time.time() - start)
+start = time.time()
+metrics = importlib.import_module({modules!r}[-1]).{func}(logging, {line!r})
+timings.append(time.time() - start)
+assert metrics, 'first line did not parse'
+print(' '.join('%f' % timing for timing in timings))
+"""
+
+
+def measure(module, runs):
+    func, line = SAMPLE_LINES[module]
+    script = MEASURE.format(modules=DEPENDENCIES + (module,), func=func, line=line)
+    runs_timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        runs_timings.append([float(timing) for timing in output.split()])
+    # best run for each measurement
+    return [min(timings) for timings in zip(*runs_timings)]
+
+
+def importtime_breakdown(module):
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        cwd=ROOT, stderr=subprocess.STDOUT,
+    )
+    return [line for line in output.decode('utf-8').splitlines() if module.split('.')[0] in line or 'parsing_utils' in line]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per module (best run is reported)')
+    args = parser.parse_args()
+
+    columns = DEPENDENCIES + ('import', 'first line')
+    print('{:<16}'.format('module (ms)') + ''.join('{:>16}'.format(column) for column in columns))
+    for module in sorted(SAMPLE_LINES):
+        timings = measure(module, args.runs)
+        print('{:<16}'.format(module) + ''.join('{:>16.2f}'.format(timing * 1000) for timing in timings))
+
+    if sys.version_info >= (3, 7):
+        for module in sorted(SAMPLE_LINES):
+            print('')
+            print('\n'.join(importtime_breakdown(module)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
-import os
-import sys
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-import re
 import collections
 from datetime import datetime
-from parsing_utils import get_unix_timestamp
+
+try:
+    from parsing_utils import LazyRegex, get_unix_timestamp, is_priority_request, scale_counters
+    from streaming import SpaceSaving, WindowedAccumulator
+except ImportError:
+    # loaded by file path (e.g. as a dogstream) without the package installed
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from parsing_utils import LazyRegex, get_unix_timestamp, is_priority_request, scale_counters
+    from streaming import SpaceSaving, WindowedAccumulator
 
 """
 Sample log line:
@@ -12,6 +18,31 @@ Sample log line:
 """
 
 WILDCARD = '*'
+DURATION_BUCKETS = ('lt_001s', 'lt_005s', 'lt_020s', 'lt_120s', 'over_120s')
+
+COST_INTERVAL = 60
+COST_TOP_N = 20
+COST_CAPACITY = 100
+OTHER = 'other'
+
+URL_SANITIZERS = [
+    # Normalize all domain names
+    (LazyRegex(r'/a/[0-9a-z-]+'), '/a/{}'.format(WILDCARD)),
+    # Normalize all urls with indexes or ids
+    (LazyRegex(r'/modules-[0-9]+'), '/modules-{}'.format(WILDCARD)),
+    (LazyRegex(r'/forms-[0-9]+'), '/forms-{}'.format(WILDCARD)),
+    (LazyRegex(r'/form_data/[a-z0-9-]+'), '/form_data/{}'.format(WILDCARD)),
+    (LazyRegex(r'/uuid:[a-z0-9-]+'), '/uuid:{}'.format(WILDCARD)),
+    (LazyRegex(r'[-0-9a-f]{10,}'), WILDCARD),
+    # Remove URL params
+    (LazyRegex(r'\?[^ ]*'), ''),
+]
+
+COUCH_URL_SANITIZERS = [
+    (LazyRegex(r'[0-9a-f]{32}'), WILDCARD),
+    # Removes dashed uuids
+    (LazyRegex(r'[-0-9a-f]{36}'), WILDCARD),
+]
 
 
 def parse_couch_logs(logger, line):
@@ -55,6 +86,84 @@ def get_couch_requests_counter(timestamp, url, task, database, http_method, stat
     }
 
 
+def is_priority_line(line):
+    pieces = line.split()
+    if len(pieces) < 8:
+        return False
+    # status code is followed by content length in all but the oldest format
+    status_code = pieces[-3] if len(pieces) == 8 else pieces[-4]
+    try:
+        request_seconds = _parse_request_time(pieces[-1])
+    except ValueError:
+        return False
+    return is_priority_request(status_code, get_duration_bucket(request_seconds))
+
+
+def parse_couch_logs_with_cost(logger, line, **kwargs):
+    """
+    ``parse_couch_logs`` plus ``couch.cost.*`` metrics each time a cost window closes.
+
+    Takes the ``sample_rate`` of the line when wrapped by ``sampling.sampled_parser``.
+    """
+    metrics = parse_couch_logs(logger, line)
+    if not metrics:
+        return metrics
+
+    sample_rate = kwargs.get('sample_rate', 1.0)
+    name, timestamp, request_seconds, attrs = metrics[0]
+    cost = COUCH_COST.add(timestamp, attrs['task'], attrs['database'], attrs['http_method'], request_seconds,
+                          1.0 / sample_rate)
+    return scale_counters(metrics, sample_rate) + cost
+
+
+class CouchCostAccumulator(WindowedAccumulator):
+    """
+    Couch request time and count per (task, database, http_method) for each interval.
+
+    Only the ``top_n`` combinations with the most request time are emitted;
+    the rest are summed under ``other``. Memory is bounded by ``capacity``.
+    The number of requests in each duration bucket is emitted as well.
+    """
+
+    def __init__(self, interval=COST_INTERVAL, top_n=COST_TOP_N, capacity=COST_CAPACITY):
+        super(CouchCostAccumulator, self).__init__(interval)
+        self.top_n = top_n
+        self._costs = SpaceSaving(max(capacity, top_n), width=2)
+        self._durations = dict.fromkeys(DURATION_BUCKETS, 0)
+
+    def observe(self, task, database, http_method, request_seconds, weight=1):
+        self._costs.add((task, database, http_method), weight * request_seconds, (weight, weight * request_seconds))
+        self._durations[get_duration_bucket(request_seconds)] += weight
+
+    def emit(self, timestamp):
+        costs, (other_requests, other_seconds) = self._costs.split(self.top_n)
+        if other_requests:
+            costs.append(((OTHER, OTHER, OTHER), [other_requests, other_seconds]))
+
+        metrics = []
+        for (task, database, http_method), (requests, request_seconds) in costs:
+            tags = {
+                'metric_type': 'counter',
+                'task': task,
+                'database': database,
+                'http_method': http_method,
+            }
+            metrics.append(('couch.cost.request_seconds', timestamp, request_seconds, dict(tags)))
+            metrics.append(('couch.cost.requests', timestamp, requests, dict(tags)))
+
+        for duration in DURATION_BUCKETS:
+            if self._durations[duration]:
+                metrics.append(('couch.cost.durations', timestamp, self._durations[duration], {
+                    'metric_type': 'counter',
+                    'duration': duration,
+                }))
+        return metrics
+
+    def reset(self):
+        self._costs.clear()
+        self._durations = dict.fromkeys(DURATION_BUCKETS, 0)
+
+
 def _parse_line(line):
     pieces = line.split()
     database = ''
@@ -84,37 +193,27 @@ def _parse_line(line):
         url = _sanitize_url(url)
     couch_url = _sanitize_couch_url(couch_url)
 
-    if ":" in request_time:
-        hours, minutes, seconds = request_time.split(':')
-        request_seconds = float(seconds) + (60 * float(minutes)) + (60 * 60 * float(hours))
-    else:
-        request_seconds = float(request_time)
+    request_seconds = _parse_request_time(request_time)
 
     return timestamp, domain, url, task_name, database, http_method, status_code, couch_url, request_seconds
 
 
-def _sanitize_url(url):
-    # Normalize all domain names
-    url = re.sub(r'/a/[0-9a-z-]+', '/a/{}'.format(WILDCARD), url)
+def _parse_request_time(request_time):
+    if ":" in request_time:
+        hours, minutes, seconds = request_time.split(':')
+        return float(seconds) + (60 * float(minutes)) + (60 * 60 * float(hours))
+    return float(request_time)
 
-    # Normalize all urls with indexes or ids
-    url = re.sub(r'/modules-[0-9]+', '/modules-{}'.format(WILDCARD), url)
-    url = re.sub(r'/forms-[0-9]+', '/forms-{}'.format(WILDCARD), url)
-    url = re.sub(r'/form_data/[a-z0-9-]+', '/form_data/{}'.format(WILDCARD), url)
-    url = re.sub(r'/uuid:[a-z0-9-]+', '/uuid:{}'.format(WILDCARD), url)
-    url = re.sub(r'[-0-9a-f]{10,}', '{}'.format(WILDCARD), url)
 
-    # Remove URL params
-    url = re.sub(r'\?[^ ]*', '', url)
+def _sanitize_url(url):
+    for pattern, replacement in URL_SANITIZERS:
+        url = pattern.sub(replacement, url)
     return url
 
 
 def _sanitize_couch_url(url):
-    url = re.sub(r'[0-9a-f]{32}', '{}'.format(WILDCARD), url)
-
-    # Removes dashed uuids
-    url = re.sub(r'[-0-9a-f]{36}', '{}'.format(WILDCARD), url)
-
+    for pattern, replacement in COUCH_URL_SANITIZERS:
+        url = pattern.sub(replacement, url)
     return url
 
 
@@ -136,3 +235,6 @@ def get_duration_bucket(duration_in_sec):
         return 'lt_120s'
     else:
         return 'over_120s'
+
+
+COUCH_COST = CouchCostAccumulator()
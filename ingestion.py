@@ -0,0 +1,241 @@
+"""
+Fair, bounded ingestion of several log files in a single process.
+
+Each source is a log file paired with the dogstream parse function that
+understands it, e.g.::
+
+    scheduler = IngestionScheduler(logger)
+    scheduler.register('nginx', '/var/log/nginx/access.log', nginx.timings.parse_logs)
+    scheduler.register('nginx_errors', '/var/log/nginx/error.log', nginx.errors.parse_nginx_errors)
+    scheduler.register('couch', '/var/log/couch-request.log', couch.parsers.parse_couch_logs)
+    scheduler.run(submit_metrics)
+
+Sources are read in bounded chunks and visited round-robin, so a burst in
+one file can delay the others by at most one chunk per round. Parsed
+metrics go to a bounded output queue; while it is full no source is read
+(backpressure), and the unread bytes show up as lag for that source.
+
+A source given a ``backfill.ProcessedLedger`` reads through it instead of
+keeping its own offset, so a backfill sharing the ledger path skips what
+was ingested live and vice versa. Lines left in a file that was renamed
+away are then picked up by the backfill rather than by the source.
+"""
+import collections
+import os
+import time
+
+DEFAULT_CHUNK_LINES = 500
+DEFAULT_CHUNK_BYTES = 256 * 1024
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_MAX_BATCH = 1000
+
+
+class LogSource(object):
+    def __init__(self, name, path, parse_func,
+                 chunk_lines=DEFAULT_CHUNK_LINES, chunk_bytes=DEFAULT_CHUNK_BYTES, ledger=None):
+        self.name = name
+        self.path = path
+        self.parse_func = parse_func
+        self.chunk_lines = chunk_lines
+        self.chunk_bytes = chunk_bytes
+        self.ledger = ledger
+        self.offset = 0
+        self.lines_read = 0
+        self.last_timestamp = None
+        self._file = None
+
+    def read_chunk(self):
+        """
+        Return up to ``chunk_lines`` complete lines (or roughly ``chunk_bytes``).
+
+        A trailing line without a newline is left unread until the writer finishes it.
+        Once a renamed (rotated) file has been read to the end, the new file at
+        ``path`` is opened and read from the start.
+        """
+        if self.ledger is not None:
+            return self._read_ledger_chunk()
+        if not self._open():
+            return []
+
+        if os.fstat(self._file.fileno()).st_size < self.offset:
+            # truncated in place (e.g. copytruncate), start again from the top
+            self.offset = 0
+
+        self._file.seek(self.offset)
+        lines = []
+        read_bytes = 0
+        at_end = False
+        while len(lines) < self.chunk_lines and read_bytes < self.chunk_bytes:
+            line = self._file.readline()
+            if not line.endswith(b'\n'):
+                at_end = True
+                break
+            read_bytes += len(line)
+            line = line.rstrip(b'\r\n')
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            lines.append(line)
+
+        self.offset += read_bytes
+        self.lines_read += len(lines)
+
+        if at_end and self._is_rotated():
+            self.close()
+            self.offset = 0
+        return lines
+
+    def lag_bytes(self):
+        if self.ledger is not None:
+            try:
+                return max(_get_size(self.path) - self.ledger.processed_bytes(self.path), 0)
+            except IOError:
+                return 0
+        if self._file is None:
+            return _get_size(self.path)
+
+        lag = max(os.fstat(self._file.fileno()).st_size - self.offset, 0)
+        if self._is_rotated():
+            # the rest of the old file plus everything in the new one
+            lag += _get_size(self.path)
+        return lag
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_ledger_chunk(self):
+        # chunk_bytes does not apply; the ledger claims whole lines
+        try:
+            lines = list(self.ledger.new_lines(self.path, max_lines=self.chunk_lines))
+        except IOError:
+            return []
+        self.lines_read += len(lines)
+        return lines
+
+    def _is_rotated(self):
+        """Whether ``path`` now names a different file from the one being read"""
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            # renamed but the new file has not been created yet
+            return False
+        opened = os.fstat(self._file.fileno())
+        return (current.st_ino, current.st_dev) != (opened.st_ino, opened.st_dev)
+
+    def _open(self):
+        if self._file is None:
+            try:
+                self._file = open(self.path, 'rb')
+            except IOError:
+                return False
+        return True
+
+
+class IngestionScheduler(object):
+    def __init__(self, logger, max_queue=DEFAULT_MAX_QUEUE, clock=time.time):
+        self.logger = logger
+        self.max_queue = max_queue
+        self.clock = clock
+        self._sources = []
+        self._next_source = 0
+        self._queue = collections.deque()
+
+    def register(self, name, path, parse_func, **kwargs):
+        source = LogSource(name, path, parse_func, **kwargs)
+        self._sources.append(source)
+        return source
+
+    @property
+    def sources(self):
+        return list(self._sources)
+
+    def is_full(self):
+        return len(self._queue) >= self.max_queue
+
+    def run_once(self):
+        """
+        Give every source at most one chunk, starting after the source that went first last time.
+
+        Stops early while the output queue is full. The queue can go over
+        ``max_queue`` by at most the metrics of one chunk.
+        Returns the number of lines parsed.
+        """
+        if not self._sources:
+            return 0
+
+        parsed = 0
+        start = self._next_source
+        for i in range(len(self._sources)):
+            if self.is_full():
+                break
+            source = self._sources[(start + i) % len(self._sources)]
+            for line in source.read_chunk():
+                self._queue.extend(self._parse(source, line))
+                parsed += 1
+
+        self._next_source = (start + 1) % len(self._sources)
+        return parsed
+
+    def drain(self, max_items=None):
+        metrics = []
+        while self._queue and (max_items is None or len(metrics) < max_items):
+            metrics.append(self._queue.popleft())
+        return metrics
+
+    def run(self, consume, idle_sleep=1.0, should_stop=lambda: False, max_batch=DEFAULT_MAX_BATCH):
+        """
+        Alternate ``run_once`` with passing at most ``max_batch`` metrics to ``consume``.
+
+        When rounds parse more than ``max_batch`` metrics the queue fills up and
+        sources stop being read until ``consume`` has caught up.
+        """
+        while not should_stop():
+            parsed = self.run_once()
+            consume(self.drain(max_batch))
+            if not parsed and not self._queue:
+                time.sleep(idle_sleep)
+
+    def lag_metrics(self):
+        now = self.clock()
+        metrics = []
+        for source in self._sources:
+            tags = {'metric_type': 'gauge', 'source': source.name}
+            metrics.append(('ingestion.lag_bytes', int(now), source.lag_bytes(), dict(tags)))
+            if source.last_timestamp is not None:
+                lag_seconds = max(now - source.last_timestamp, 0)
+                metrics.append(('ingestion.lag_seconds', int(now), lag_seconds, dict(tags)))
+        metrics.append(('ingestion.queue_size', int(now), len(self._queue), {'metric_type': 'gauge'}))
+        return metrics
+
+    def close(self):
+        for source in self._sources:
+            source.close()
+
+    def _parse(self, source, line):
+        try:
+            result = source.parse_func(self.logger, line)
+        except Exception:
+            self.logger.exception('Parser for %s failed on line', source.name)
+            return []
+
+        metrics = _as_metric_list(result)
+        if metrics:
+            source.last_timestamp = metrics[-1][1]
+        return metrics
+
+
+def _get_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _as_metric_list(result):
+    # parsers return None, a single metric tuple, or a list of metric tuples
+    if not result:
+        return []
+    if isinstance(result, tuple):
+        return [result]
+    return [metric for metric in result if metric]
@@ -1,20 +1,24 @@
-import os
-import sys
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from parsing_utils import get_unix_timestamp
-import re
 from collections import namedtuple
 from datetime import datetime
 
+try:
+    from parsing_utils import LazyRegex, get_unix_timestamp
+except ImportError:
+    # loaded by file path (e.g. as a dogstream) without the package installed
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from parsing_utils import LazyRegex, get_unix_timestamp
+
 
 SHARED_DETAILS_REGEXES = [
-    r'(?P<timestamp>\d\d\d\d/\d\d/\d\d \d\d:\d\d:\d\d) \[(?P<log_level>\w+)\].*'
+    LazyRegex(r'(?P<timestamp>\d\d\d\d/\d\d/\d\d \d\d:\d\d:\d\d) \[(?P<log_level>\w+)\].*'),
 ]
 
 TYPE_REGEXES = [
-    (r'connect\(\) failed \(111: Connection refused\) while connecting to upstream', 'connection_refused'),
-    (r'an upstream response is buffered to a temporary file', 'buffer_to_file/upstream'),
-    (r'a client request body is buffered to a temporary file', 'buffer_to_file/client'),
+    (LazyRegex(r'connect\(\) failed \(111: Connection refused\) while connecting to upstream'), 'connection_refused'),
+    (LazyRegex(r'an upstream response is buffered to a temporary file'), 'buffer_to_file/upstream'),
+    (LazyRegex(r'a client request body is buffered to a temporary file'), 'buffer_to_file/client'),
 ]
 
 
@@ -49,7 +53,7 @@ def _get_log_details(logger, line):
 def _parse_line(line):
     groupdict = None
     for regex in SHARED_DETAILS_REGEXES:
-        match = re.match(regex, line)
+        match = regex.match(line)
         if match:
             groupdict = match.groupdict()
             break
@@ -58,7 +62,7 @@ def _parse_line(line):
         raise Exception('No parsers match line: "{}"'.format(line))
 
     for regex, error_type in TYPE_REGEXES:
-        if re.search(regex, line):
+        if regex.search(line):
             break
     else:
         error_type = 'other'
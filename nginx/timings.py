@@ -1,16 +1,26 @@
-import os
-import sys
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from parsing_utils import get_unix_timestamp
+import logging
+import math
 import re
-from collections import namedtuple
+from collections import deque, namedtuple
 from datetime import datetime
-import urlparse
-import logging
-logging.basicConfig(level=logging.INFO)
+
+try:
+    from parsing_utils import LazyRegex, get_unix_timestamp, is_priority_request, scale_counters
+    from streaming import SpaceSaving, WindowedAccumulator
+except ImportError:
+    # loaded by file path (e.g. as a dogstream) without the package installed
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from parsing_utils import LazyRegex, get_unix_timestamp, is_priority_request, scale_counters
+    from streaming import SpaceSaving, WindowedAccumulator
+
+log = logging.getLogger(__name__)
+
+WILDCARD = '*'
 
 PARSER_RX = [
-    r"^\[(?P<timestamp>[^]]+)\] ((?P<cache_status>[\w-]+) )?((?P<http_method>\w+) (?P<url>.+) (http\/\d\.\d)) (?P<status_code>\d{3}) (?P<request_time>\d+\.?\d*)( (?P<referer>.+))?",
+    LazyRegex(r"^\[(?P<timestamp>[^]]+)\] ((?P<cache_status>[\w-]+) )?((?P<http_method>\w+) (?P<url>.+) (http\/\d\.\d)) (?P<status_code>\d{3}) (?P<request_time>\d+\.?\d*)( (?P<referer>.+))?", re.IGNORECASE),
 ]
 
 TIMING_TAGS = {
@@ -30,20 +40,36 @@ REQUEST_TAGS = {
 # These patterns are to be tried _in order_
 # Group name is given by the `group_name` matching group, with the second element as fallback
 URL_PATTERN_GROUPS = [
-    (re.compile(r'^/a/[^/]+/(?P<group_name>phone/[^/]+)'), None),
-    (re.compile(r'^/a/[^/]+/(?P<group_name>[^/]+)'), None),
+    (LazyRegex(r'^/a/[^/]+/(?P<group_name>phone/[^/]+)'), None),
+    (LazyRegex(r'^/a/[^/]+/(?P<group_name>[^/]+)'), None),
     # Exact match
-    (re.compile(r'^/home/$'), '/home/'),
-    (re.compile(r'^/pricing/$'), '/pricing/'),
-    (re.compile(r'^/accounts/login/$'), 'login'),
+    (LazyRegex(r'^/home/$'), '/home/'),
+    (LazyRegex(r'^/pricing/$'), '/pricing/'),
+    (LazyRegex(r'^/accounts/login/$'), 'login'),
     # Prefix match
-    (re.compile(r'^/formplayer/'), 'formplayer'),
-    (re.compile(r'^/hq/multimedia/file/CommCareAudio/'), 'mm/audio'),
-    (re.compile(r'^/hq/multimedia/file/CommCareVideo/'), 'mm/video'),
-    (re.compile(r'^/hq/multimedia/file/CommCareImage/'), 'mm/image'),
-    (re.compile(r'^/hq/multimedia/file/'), 'mm/other'),
+    (LazyRegex(r'^/formplayer/'), 'formplayer'),
+    (LazyRegex(r'^/hq/multimedia/file/CommCareAudio/'), 'mm/audio'),
+    (LazyRegex(r'^/hq/multimedia/file/CommCareVideo/'), 'mm/video'),
+    (LazyRegex(r'^/hq/multimedia/file/CommCareImage/'), 'mm/image'),
+    (LazyRegex(r'^/hq/multimedia/file/'), 'mm/other'),
+]
+
+URL_SANITIZERS = [
+    # Normalize all domain names
+    (LazyRegex(r'/a/[0-9a-z-]+'), '/a/{}'.format(WILDCARD)),
+    # Normalize all urls with indexes or ids
+    (LazyRegex(r'/modules-[0-9]+'), '/modules-{}'.format(WILDCARD)),
+    (LazyRegex(r'/forms-[0-9]+'), '/forms-{}'.format(WILDCARD)),
+    (LazyRegex(r'/form_data/[a-z0-9-]+'), '/form_data/{}'.format(WILDCARD)),
+    (LazyRegex(r'/uuid:[a-z0-9-]+'), '/uuid:{}'.format(WILDCARD)),
+    (LazyRegex(r'[-0-9a-f]{10,}'), WILDCARD),
+    # Remove URL params
+    (LazyRegex(r'\?[^ ]*'), ''),
 ]
 
+SKIP_RX = LazyRegex(r'/static/')
+DOMAIN_RX = LazyRegex(r'/a/(?P<domain>[0-9a-z-]+)')
+
 MM_MAPPING = {
     'CommCareAudio': 'mm/audio',
     'CommCareVideo': 'mm/video',
@@ -57,7 +83,7 @@ class LogDetails(namedtuple('LogDetails', 'timestamp, cache_status, http_method,
         if not self.cache_status:
             del tags['cache_status']
 
-        for tag in tags:
+        for tag in list(tags):
             if tag not in tag_whitelist:
                 del tags[tag]
 
@@ -65,15 +91,64 @@ class LogDetails(namedtuple('LogDetails', 'timestamp, cache_status, http_method,
         return tags
 
 
-WILDCARD = '*'
 APDEX_THRESHOLDS = (3, 12)
 
+# Cheap pre-parse check used by the sampler; only looks at status code and request time
+PRIORITY_RX = LazyRegex(r' HTTP/\d\.\d (?P<status_code>\d{3}) (?P<request_time>\d+\.?\d*)', re.IGNORECASE)
+
+DOMAIN_ROLLUP_INTERVAL = 60
+DOMAIN_ROLLUP_TOP_N = 25
+DOMAIN_ROLLUP_CAPACITY = 100
+OTHER_DOMAINS = 'other'
+
+ERROR_BUDGET_INTERVAL = 300
+DEFAULT_SLO_TARGET = 0.999
+# url_group -> fraction of requests that must not be server errors; read when
+# ERROR_BUDGET is created, use ERROR_BUDGET.set_target to change targets later
+SLO_TARGETS = {}
+BURN_RATE_WINDOWS = (
+    ('5m', 300),
+    ('1h', 3600),
+)
+
 
 def parse_logs(logger, line , *args):
     details = _get_log_details(logger, line)
     if not details:
         return None
+    return _get_request_metrics(details, _get_url_group(details.url))
+
+
+def parse_logs_with_domain_rollup(logger, line, *args, **kwargs):
+    """
+    ``parse_logs`` plus ``nginx.domain.*`` metrics each time a rollup interval closes.
+
+    Takes the ``sample_rate`` of the line when wrapped by ``sampling.sampled_parser``.
+    """
+    details = _get_log_details(logger, line)
+    if not details:
+        return None
+    sample_rate = kwargs.get('sample_rate', 1.0)
+    metrics = scale_counters(_get_request_metrics(details, _get_url_group(details.url)), sample_rate)
+    return metrics + DOMAIN_ROLLUP.add(details.timestamp, details, 1.0 / sample_rate)
+
+
+def parse_logs_with_error_budget(logger, line, *args, **kwargs):
+    """
+    ``parse_logs`` plus error ratio and SLO burn rate metrics each time a bucket closes.
+
+    Takes the ``sample_rate`` of the line when wrapped by ``sampling.sampled_parser``.
+    """
+    details = _get_log_details(logger, line)
+    if not details:
+        return None
+    sample_rate = kwargs.get('sample_rate', 1.0)
     url_group = _get_url_group(details.url)
+    metrics = scale_counters(_get_request_metrics(details, url_group), sample_rate)
+    return metrics + ERROR_BUDGET.add(details.timestamp, url_group, details.status_code, 1.0 / sample_rate)
+
+
+def _get_request_metrics(details, url_group):
     referer_group = _get_url_group(details.referer) if details.referer else 'unknown'
 
     return [
@@ -132,6 +207,142 @@ def get_duration_bucket(duration_in_sec):
         return 'over_120s'
 
 
+class DomainRollup(WindowedAccumulator):
+    """
+    Request count and total request time per project domain for each interval.
+
+    Only the ``top_n`` busiest domains are emitted with a ``domain`` tag; all
+    other domains are summed under ``other``. Memory is bounded by
+    ``capacity`` however many domains are seen. Requests outside a project
+    domain are not counted.
+    """
+
+    def __init__(self, interval=DOMAIN_ROLLUP_INTERVAL, top_n=DOMAIN_ROLLUP_TOP_N, capacity=DOMAIN_ROLLUP_CAPACITY):
+        super(DomainRollup, self).__init__(interval)
+        self.top_n = top_n
+        self._domains = SpaceSaving(max(capacity, top_n), width=2)
+
+    def observe(self, details, weight=1):
+        if details.domain:
+            self._domains.add(details.domain, weight, (weight, weight * details.request_time))
+
+    def emit(self, timestamp):
+        rollup, (other_requests, other_request_time) = self._domains.split(self.top_n)
+        if other_requests:
+            rollup.append((OTHER_DOMAINS, [other_requests, other_request_time]))
+
+        metrics = []
+        for domain, (requests, request_time) in rollup:
+            tags = {'metric_type': 'counter', 'domain': domain}
+            metrics.append(('nginx.domain.requests', timestamp, requests, dict(tags)))
+            metrics.append(('nginx.domain.request_time', timestamp, request_time, dict(tags)))
+        return metrics
+
+    def reset(self):
+        self._domains.clear()
+
+
+DOMAIN_ROLLUP = DomainRollup()
+
+
+def _check_slo_target(url_group, target):
+    if not 0 <= target < 1:
+        raise ValueError('SLO target for {} must be at least 0 and below 1, not {!r}'.format(url_group, target))
+    return target
+
+
+class ErrorBudgetAccumulator(WindowedAccumulator):
+    """
+    Good and bad request counts per url_group, summarised every ``interval`` seconds.
+
+    For each bucket this emits ``nginx.error_ratio`` (4xx and 5xx as fractions of
+    all requests) and, for each burn rate window, ``nginx.slo.burn_rate``: the
+    5xx ratio over the window divided by the error budget ``1 - target``.
+    A burn rate of 1 uses up the budget exactly over the SLO period.
+
+    Only as many buckets as the longest window spans are kept per url_group,
+    and url_groups with no requests in that span are dropped.
+
+    Targets must be at least 0 and below 1 (a target of 1 leaves no budget to
+    burn); change them with ``set_target`` so they are checked.
+    """
+
+    def __init__(self, interval=ERROR_BUDGET_INTERVAL, targets=None, default_target=DEFAULT_SLO_TARGET,
+                 windows=BURN_RATE_WINDOWS):
+        super(ErrorBudgetAccumulator, self).__init__(interval)
+        self.default_target = _check_slo_target('default', default_target)
+        self.targets = {}
+        for url_group, target in (SLO_TARGETS if targets is None else targets).items():
+            self.set_target(url_group, target)
+        self.windows = windows
+        self._max_buckets = max(int(math.ceil(seconds / float(interval))) for name, seconds in windows)
+        self._current = {}
+        self._history = {}
+
+    def set_target(self, url_group, target):
+        self.targets[url_group] = _check_slo_target(url_group, target)
+
+    def observe(self, url_group, status_code, weight=1):
+        counts = self._current.get(url_group)
+        if counts is None:
+            counts = self._current[url_group] = [0, 0, 0]
+        counts[0] += weight
+        if status_code.startswith('4'):
+            counts[1] += weight
+        elif status_code.startswith('5'):
+            counts[2] += weight
+
+    def emit(self, timestamp):
+        for url_group, (total, client_errors, server_errors) in self._current.items():
+            history = self._history.get(url_group)
+            if history is None:
+                history = self._history[url_group] = deque(maxlen=self._max_buckets)
+            history.append((timestamp, total, server_errors))
+
+        metrics = []
+        for url_group, history in list(self._history.items()):
+            if history[-1][0] <= timestamp - self._max_buckets * self.interval:
+                del self._history[url_group]
+                continue
+
+            if url_group in self._current:
+                total, client_errors, server_errors = self._current[url_group]
+                for status_class, errors in (('4xx', client_errors), ('5xx', server_errors)):
+                    metrics.append(('nginx.error_ratio', timestamp, float(errors) / total, {
+                        'metric_type': 'gauge',
+                        'url_group': url_group,
+                        'status_class': status_class,
+                    }))
+
+            error_budget = 1 - self.targets.get(url_group, self.default_target)
+            for window, seconds in self.windows:
+                window_total = window_errors = 0
+                for bucket_timestamp, total, server_errors in history:
+                    if bucket_timestamp > timestamp - seconds:
+                        window_total += total
+                        window_errors += server_errors
+                if window_total:
+                    metrics.append(('nginx.slo.burn_rate', timestamp, float(window_errors) / window_total / error_budget, {
+                        'metric_type': 'gauge',
+                        'url_group': url_group,
+                        'window': window,
+                    }))
+        return metrics
+
+    def reset(self):
+        self._current = {}
+
+
+ERROR_BUDGET = ErrorBudgetAccumulator()
+
+
+def is_priority_line(line):
+    match = PRIORITY_RX.search(line)
+    if not match:
+        return False
+    return is_priority_request(match.group('status_code'), get_duration_bucket(float(match.group('request_time'))))
+
+
 def _get_log_details(logger, line):
     if not line:
         return None
@@ -158,19 +369,19 @@ def _get_url_group(url):
 
 
 def _should_skip_log(url):
-    return re.search(r'^/static/', url)
+    return SKIP_RX.match(url)
 
 
 def _parse_line(line):
     groupdict = None
     for parser in PARSER_RX:
-        match = re.match(parser, line, re.IGNORECASE)
+        match = parser.match(line)
         if match:
             groupdict = match.groupdict()
             break
 
     if not groupdict:
-        logging.warning('No parsers match line: "{}"'.format(line)) 
+        log.warning('No parsers match line: "%s"', line)
         return None
 
     fields = {}
@@ -182,32 +393,33 @@ def _parse_line(line):
 
 
 def _sanitize_url(_, url):
-    # Normalize all domain names
-    url = re.sub(r'/a/[0-9a-z-]+', '/a/{}'.format(WILDCARD), url)
-
-    # Normalize all urls with indexes or ids
-    url = re.sub(r'/modules-[0-9]+', '/modules-{}'.format(WILDCARD), url)
-    url = re.sub(r'/forms-[0-9]+', '/forms-{}'.format(WILDCARD), url)
-    url = re.sub(r'/form_data/[a-z0-9-]+', '/form_data/{}'.format(WILDCARD), url)
-    url = re.sub(r'/uuid:[a-z0-9-]+', '/uuid:{}'.format(WILDCARD), url)
-    url = re.sub(r'[-0-9a-f]{10,}', '{}'.format(WILDCARD), url)
-
-    # Remove URL params
-    url = re.sub(r'\?[^ ]*', '', url)
+    for pattern, replacement in URL_SANITIZERS:
+        url = pattern.sub(replacement, url)
     return url
 
 
 def _sanitize_referer(_, url):
     if url and url != '-':
         if url.startswith('http'):
-            url = urlparse.urlsplit(url).path
+            url = _urlsplit(url).path
         return _sanitize_url(_, url)
     return url
 
 
+def _urlsplit(url):
+    # import on first use, then replace this function with the imported one
+    global _urlsplit
+    try:
+        from urlparse import urlsplit
+    except ImportError:
+        from urllib.parse import urlsplit
+    _urlsplit = urlsplit
+    return urlsplit(url)
+
+
 def _extract_domain(all_fields, _):
     url = all_fields['url']
-    match = re.search(r'/a/(?P<domain>[0-9a-z-]+)', url)
+    match = DOMAIN_RX.search(url)
     if not match:
         return ''
     return match.group('domain')
@@ -1,10 +1,56 @@
 import calendar
+import re
 
 
 def get_unix_timestamp(naive_datetime_representing_utc):
     return calendar.timegm(naive_datetime_representing_utc.utctimetuple())
 
 
+# requests in these duration buckets are always kept when sampling
+PRIORITY_DURATIONS = {'lt_120s', 'over_120s'}
+
+
+def is_priority_request(status_code, duration_bucket):
+    """Server errors and slow requests are never sampled out"""
+    return status_code.startswith('5') or duration_bucket in PRIORITY_DURATIONS
+
+
+def scale_counters(result, rate):
+    """Divide the counters of a parse result by the rate its line was kept at"""
+    if not result or rate >= 1:
+        return result
+    if isinstance(result, tuple):
+        return _scale_counter(result, rate)
+    return [_scale_counter(metric, rate) for metric in result]
+
+
+def _scale_counter(metric, rate):
+    name, timestamp, value, attrs = metric
+    if attrs.get('metric_type') != 'counter':
+        return metric
+    return name, timestamp, value / rate, attrs
+
+
+class LazyRegex(object):
+    """
+    A regex that is only compiled the first time it is used.
+
+    After that the compiled pattern's methods are bound directly on the instance,
+    so later calls cost the same as calling them on the compiled pattern.
+    """
+    _METHODS = ('match', 'search', 'sub', 'subn', 'split', 'findall', 'finditer', 'groupindex')
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        compiled = re.compile(self.pattern, self.flags)
+        for method in self._METHODS:
+            setattr(self, method, getattr(compiled, method))
+        return getattr(compiled, name)
+
+
 class UnixTimestampTestMixin(object):
     def assert_timestamp_equal(self, actual_timestamp, expected_utc_datetime, expected_timestamp=None):
         """
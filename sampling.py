@@ -0,0 +1,96 @@
+"""
+Adaptive load shedding for the line parsers.
+
+``AdaptiveSampler`` keeps the number of lines parsed per interval close to a
+fixed budget. At the end of each interval the sample rate becomes
+``budget / lines seen in that interval`` (clamped to ``[min_rate, 1]``), so
+the parse cost per host stays bounded however fast the logs grow, and
+goes back to parsing everything once the spike is over.
+
+Priority lines (server errors and slow requests, see ``is_priority_line``
+in ``nginx.timings`` and ``couch.parsers``) are always kept and do not
+count against the budget. Error log lines should not be sampled at all.
+
+Accuracy: every other line is kept with probability ``r`` and its counter
+metrics are emitted with value ``1 / r``. Summed counters are therefore
+unbiased estimates of the true totals. For ``N`` lines subject to sampling
+(kept and dropped) at rate ``r``, the relative standard error of a counter
+total is ``sqrt((1 - r) / (r * N))``; e.g. 10% sampling of 10,000 lines
+(about 1,000 kept) is accurate to about 3%. Priority lines are counted
+exactly. Gauges (timings, apdex) are not rescaled, so their distributions
+over-represent priority lines while sampling is active.
+
+Parsers that aggregate across lines (``parse_logs_with_domain_rollup``,
+``parse_logs_with_error_budget``, ``parse_couch_logs_with_cost``) must be
+wrapped with ``aggregating=True``. They are then given the ``sample_rate`` and
+count each kept line ``1 / r`` times in their windows, and the window totals
+they flush are emitted as they are rather than scaled by the rate of the line
+that closed the window.
+"""
+import random
+import time
+
+from parsing_utils import scale_counters
+
+DEFAULT_INTERVAL = 10
+DEFAULT_MIN_RATE = 0.001
+
+
+class AdaptiveSampler(object):
+    def __init__(self, max_lines_per_interval, interval=DEFAULT_INTERVAL, min_rate=DEFAULT_MIN_RATE,
+                 clock=time.time, rng=None):
+        self.max_lines_per_interval = max_lines_per_interval
+        self.interval = interval
+        self.min_rate = min_rate
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.rate = 1.0
+        self._interval_start = None
+        self._seen = 0
+
+    def sample(self, priority=False):
+        """Return the sample rate the line was kept at, or ``None`` if it should be dropped"""
+        self._tick()
+        if priority:
+            return 1.0
+
+        self._seen += 1
+        if self.rate >= 1 or self.rng.random() < self.rate:
+            return self.rate
+        return None
+
+    def _tick(self):
+        now = self.clock()
+        if self._interval_start is None:
+            self._interval_start = now
+        elif now - self._interval_start >= self.interval:
+            if self._seen:
+                rate = float(self.max_lines_per_interval) / self._seen
+                self.rate = min(max(rate, self.min_rate), 1.0)
+            else:
+                self.rate = 1.0
+            self._interval_start = now
+            self._seen = 0
+
+
+def sampled_parser(parse_func, sampler, is_priority, aggregating=False):
+    """
+    Wrap a dogstream parse function so lines are dropped according to ``sampler``
+    and counters of kept lines are scaled by the inverse of the sample rate.
+
+    With ``aggregating`` the rate is passed to ``parse_func`` as ``sample_rate``
+    and scaling is left to it.
+    """
+    def parse(logger, line, *args):
+        if not line:
+            return None
+
+        rate = sampler.sample(is_priority(line))
+        if rate is None:
+            return None
+
+        if aggregating:
+            return parse_func(logger, line, *args, sample_rate=rate)
+        return scale_counters(parse_func(logger, line, *args), rate)
+
+    return parse
@@ -0,0 +1,10 @@
+from setuptools import setup
+
+setup(
+    name='datadog-parsers',
+    version='0.1.0',
+    description='Datadog dogstream parsers for nginx and couch logs',
+    url='https://github.com/dimagi/datadog-parsers',
+    py_modules=['parsing_utils', 'backfill', 'ingestion', 'sampling', 'streaming'],
+    packages=['nginx', 'couch'],
+)
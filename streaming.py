@@ -0,0 +1,123 @@
+"""
+Fixed-memory building blocks for in-stream aggregation.
+"""
+import heapq
+
+
+class SpaceSaving(object):
+    """
+    Track the heaviest keys of a stream in at most ``capacity`` entries.
+
+    This is the space-saving algorithm (Metwally et al.): when a new key
+    arrives and the table is full, the lightest entry is evicted and the new
+    key inherits its weight as an upper bound on its error. Any key whose
+    true weight exceeds ``total weight / capacity`` is guaranteed to be tracked.
+    ``top`` ranks keys by guaranteed weight (weight minus error), so keys that
+    only just replaced an evicted entry do not outrank the real heavy hitters.
+
+    Each entry also sums ``width`` values (e.g. request count and total time).
+    Values are exact from the moment a key was inserted; the values of evicted
+    entries are kept in a single remainder so nothing is lost from the totals.
+    """
+
+    def __init__(self, capacity, width=1):
+        self.capacity = capacity
+        self.width = width
+        self._entries = {}
+        # one (weight, key) per entry; weights only grow, so a stale heap weight
+        # is a lower bound and is refreshed when it reaches the top
+        self._heap = []
+        self._evicted = [0] * width
+
+    def add(self, key, weight, values):
+        entry = self._entries.get(key)
+        if entry is None:
+            floor = 0
+            if len(self._entries) >= self.capacity:
+                floor = self._evict()
+            entry = self._entries[key] = [floor, floor, [0] * self.width]
+            heapq.heappush(self._heap, (floor + weight, key))
+        entry[0] += weight
+        totals = entry[2]
+        for i, value in enumerate(values):
+            totals[i] += value
+
+    def split(self, n):
+        """
+        The ``n`` heaviest keys as ``(key, values)`` pairs, heaviest first, and the
+        summed values of everything else, including evicted keys.
+        """
+        ranked = sorted(self._entries.items(), key=lambda item: item[1][0] - item[1][1], reverse=True)
+        remainder = list(self._evicted)
+        for key, (weight, error, totals) in ranked[n:]:
+            for i, value in enumerate(totals):
+                remainder[i] += value
+        return [(key, list(totals)) for key, (weight, error, totals) in ranked[:n]], remainder
+
+    def top(self, n):
+        return self.split(n)[0]
+
+    def remainder(self, n):
+        return self.split(n)[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._heap = []
+        self._evicted = [0] * self.width
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        while True:
+            heap_weight, victim = self._heap[0]
+            if heap_weight == self._entries[victim][0]:
+                break
+            heapq.heapreplace(self._heap, (self._entries[victim][0], victim))
+        heapq.heappop(self._heap)
+        weight, error, totals = self._entries.pop(victim)
+        for i, value in enumerate(totals):
+            self._evicted[i] += value
+        return weight
+
+
+class WindowedAccumulator(object):
+    """
+    Base for aggregations over tumbling windows of log time.
+
+    Subclasses implement ``observe`` (add one record), ``emit`` (metrics for the
+    window starting at the given timestamp) and ``reset``. ``add`` returns the
+    metrics of the previous window once a record from a later window arrives.
+    Records older than the current window are counted in the current window.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.window_start = None
+
+    def add(self, timestamp, *args):
+        flushed = []
+        window_start = timestamp - timestamp % self.interval
+        if self.window_start is None:
+            self.window_start = window_start
+        elif window_start > self.window_start:
+            flushed = self.flush()
+            self.window_start = window_start
+        self.observe(*args)
+        return flushed
+
+    def flush(self):
+        if self.window_start is None:
+            return []
+        metrics = self.emit(self.window_start)
+        self.reset()
+        return metrics
+
+    def observe(self, *args):
+        raise NotImplementedError
+
+    def emit(self, timestamp):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
@@ -0,0 +1,187 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import hashlib
+import unittest
+from backfill import BloomFilter, ProcessedLedger
+from nginx.timings import parse_logs
+
+logging.basicConfig(level=logging.DEBUG)
+
+LINE = '[28/Oct/2015:15:18:{:02d} +0000] GET /a/uth-rhd/api/case/{} HTTP/1.1 200 0.242\n'
+
+
+def _lines(start, stop):
+    return ''.join(LINE.format(i % 60, i) for i in range(start, stop))
+
+
+class TestProcessedLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ledger_path = os.path.join(self.dir, 'ledger.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _write(self, name, content, mode='ab'):
+        with open(self._path(name), mode) as f:
+            f.write(content)
+
+    def _new_lines(self, name, ledger=None):
+        ledger = ledger or ProcessedLedger(self.ledger_path)
+        return list(ledger.new_lines(self._path(name)))
+
+    def test_appended_lines(self):
+        self._write('access.log', _lines(0, 10))
+        self.assertEqual(len(self._new_lines('access.log')), 10)
+        self.assertEqual(self._new_lines('access.log'), [])
+
+        self._write('access.log', _lines(10, 200))
+        self.assertEqual(len(self._new_lines('access.log')), 190)
+
+    def test_partial_line_left_for_next_run(self):
+        self._write('access.log', _lines(0, 2) + LINE.format(2, 2).rstrip('\n'))
+        self.assertEqual(len(self._new_lines('access.log')), 2)
+        self._write('access.log', '\n')
+        self.assertEqual(self._new_lines('access.log'), [LINE.format(2, 2).rstrip('\n')])
+
+    def test_rotation_and_gzip(self):
+        self._write('access.log', _lines(0, 100))
+        self.assertEqual(len(self._new_lines('access.log')), 100)
+
+        os.rename(self._path('access.log'), self._path('access.log.1'))
+        self._write('access.log', _lines(100, 150))
+        self.assertEqual(self._new_lines('access.log.1'), [])
+        self.assertEqual(len(self._new_lines('access.log')), 50)
+
+        with open(self._path('access.log.1'), 'rb') as f:
+            content = f.read()
+        os.remove(self._path('access.log.1'))
+        gz = gzip.open(self._path('access.log.2.gz'), 'wb')
+        gz.write(content)
+        gz.close()
+        self.assertEqual(self._new_lines('access.log.2.gz'), [])
+
+    def test_unprocessed_gzip_is_parsed_once(self):
+        gz = gzip.open(self._path('access.log.2.gz'), 'wb')
+        gz.write(_lines(0, 100))
+        gz.close()
+        ledger = ProcessedLedger(self.ledger_path)
+        metrics = list(ledger.parse_file(self._path('access.log.2.gz'), parse_logs, logging))
+        self.assertEqual(len([metric for metric in metrics if metric[0] == 'nginx.requests']), 100)
+        self.assertEqual(list(ledger.parse_file(self._path('access.log.2.gz'), parse_logs, logging)), [])
+
+    def test_copytruncate_overlap(self):
+        self._write('access.log', _lines(0, 100))
+        self.assertEqual(len(self._new_lines('access.log')), 100)
+
+        # lines 95-99 are written again after the copy, before the truncate
+        shutil.copy(self._path('access.log'), self._path('access.log.1'))
+        self._write('access.log', _lines(95, 120), mode='wb')
+
+        self.assertEqual(self._new_lines('access.log.1'), [])
+        self.assertEqual(self._new_lines('access.log'), _lines(100, 120).splitlines())
+
+    def test_truncated_and_rewritten(self):
+        self._write('access.log', _lines(0, 100))
+        self.assertEqual(len(self._new_lines('access.log')), 100)
+
+        self._write('access.log', _lines(1000, 1010), mode='wb')
+        self.assertEqual(self._new_lines('access.log'), _lines(1000, 1010).splitlines())
+
+    def test_same_head_different_tail(self):
+        self._write('access.log', _lines(0, 100))
+        self.assertEqual(len(self._new_lines('access.log')), 100)
+
+        self._write('access.log', _lines(0, 90) + _lines(2000, 2020), mode='wb')
+        self.assertEqual(self._new_lines('access.log'), _lines(2000, 2020).splitlines())
+
+    def test_reset_is_not_undone_by_stale_ledger(self):
+        self._write('access.log', _lines(0, 200))
+        live = ProcessedLedger(self.ledger_path, edge_lines=10)
+        backfill = ProcessedLedger(self.ledger_path, edge_lines=10)
+        self.assertEqual(len(self._new_lines('access.log', live)), 200)
+        self.assertEqual(self._new_lines('access.log', backfill), [])
+
+        # same first block, different and shorter tail
+        self._write('access.log', _lines(0, 100) + _lines(2000, 2010), mode='wb')
+        # only the first 10 lines are edges, the rest of the old content is read again
+        self.assertEqual(self._new_lines('access.log', live), _lines(10, 100).splitlines() + _lines(2000, 2010).splitlines())
+        # the other instance still holds the old, larger offset
+        self.assertEqual(self._new_lines('access.log', backfill), [])
+
+    def test_ledger_is_unlocked_between_chunks(self):
+        self._write('access.log', _lines(0, 100))
+        live = ProcessedLedger(self.ledger_path, chunk_lines=10)
+        lines = live.new_lines(self._path('access.log'))
+        self.assertEqual([next(lines) for i in range(5)], _lines(0, 5).splitlines())
+
+        live.save()
+        backfill = ProcessedLedger(self.ledger_path)
+        self.assertEqual(self._new_lines('access.log', backfill), _lines(10, 100).splitlines())
+        self.assertEqual(list(lines), _lines(5, 10).splitlines())
+
+    def test_edges_are_recorded_once_per_file(self):
+        ledger = ProcessedLedger(self.ledger_path, edge_lines=10)
+        for i in range(20):
+            self._write('access.log', _lines(i * 5, i * 5 + 5))
+            self.assertEqual(len(self._new_lines('access.log', ledger)), 5)
+        # the head is complete; the tail waits for the next new file
+        self.assertEqual(ledger.bloom.count, 10)
+
+        self._write('access.log.1', _lines(1000, 1010))
+        self.assertEqual(len(self._new_lines('access.log.1', ledger)), 10)
+        # plus the tail of access.log and the (complete) head of access.log.1
+        self.assertEqual(ledger.bloom.count, 30)
+
+    def test_bloom_generations_are_bounded(self):
+        ledger = ProcessedLedger(self.ledger_path, edge_lines=10, bloom_capacity=15)
+        size = len(ledger.bloom.bits)
+        for i in range(5):
+            self._write('access.log.{}'.format(i), _lines(i * 100, i * 100 + 50))
+            self.assertEqual(len(self._new_lines('access.log.{}'.format(i), ledger)), 50)
+        self.assertLessEqual(ledger.bloom.count, 15)
+        self.assertEqual(len(ledger.previous_bloom.bits), size)
+        self.assertEqual(len(ProcessedLedger(self.ledger_path).files), 5)
+
+    def test_bloom_false_positive_rate(self):
+        bloom = BloomFilter.for_capacity(2000, 0.001)
+        for i in range(2000):
+            bloom.add(hashlib.sha1(b'seen %d' % i).hexdigest())
+        false_positives = sum(1 for i in range(20000) if hashlib.sha1(b'new %d' % i).hexdigest() in bloom)
+        self.assertLess(false_positives, 40)
+
+    def test_two_ledgers_share_progress(self):
+        self._write('access.log', _lines(0, 100))
+        self._write('access.log.1', _lines(1000, 1050))
+        live = ProcessedLedger(self.ledger_path)
+        backfill = ProcessedLedger(self.ledger_path)
+
+        self.assertEqual(len(self._new_lines('access.log', live)), 100)
+        # the other instance picks up what was processed since it was created
+        self.assertEqual(self._new_lines('access.log', backfill), [])
+        self.assertEqual(len(self._new_lines('access.log.1', backfill)), 50)
+
+        self._write('access.log', _lines(100, 110))
+        self.assertEqual(len(self._new_lines('access.log', live)), 10)
+        self.assertEqual(self._new_lines('access.log.1', live), [])
+
+        # saving a stale instance does not lose the other's progress
+        backfill.save()
+        ledger = ProcessedLedger(self.ledger_path)
+        self.assertEqual(self._new_lines('access.log', ledger), [])
+        self.assertEqual(self._new_lines('access.log.1', ledger), [])
+
+    def test_stopping_early_keeps_progress(self):
+        self._write('access.log', _lines(0, 100))
+        lines = ProcessedLedger(self.ledger_path).new_lines(self._path('access.log'))
+        for i in range(10):
+            next(lines)
+        lines.close()
+        self.assertEqual(self._new_lines('access.log'), _lines(10, 100).splitlines())
@@ -1,7 +1,8 @@
 import logging
 import unittest
 import datetime
-from couch.parsers import parse_couch_logs
+from couch import parsers
+from couch.parsers import CouchCostAccumulator, parse_couch_logs, parse_couch_logs_with_cost
 from parsing_utils import UnixTimestampTestMixin
 
 logging.basicConfig(level=logging.DEBUG)
@@ -115,3 +116,49 @@ class TestCouchLogParser(UnixTimestampTestMixin, unittest.TestCase):
             'database': 'commcarehq',
             'task': 'corehq.apps.tasks.build_app',
         })
+
+
+class TestCouchCostAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        # parse_couch_logs_with_cost accumulates into the module-level COUCH_COST
+        self._couch_cost = parsers.COUCH_COST
+        parsers.COUCH_COST = CouchCostAccumulator()
+
+    def tearDown(self):
+        parsers.COUCH_COST = self._couch_cost
+
+    def test_top_costs_and_remainder(self):
+        costs = CouchCostAccumulator(interval=60, top_n=2)
+        costs.add(0, 'build_app', 'commcarehq__apps', 'GET', 30)
+        costs.add(0, 'build_app', 'commcarehq__apps', 'GET', 10)
+        costs.add(0, '', 'commcarehq', 'PUT', 0.5)
+        costs.add(0, '', 'commcarehq', 'PUT', 0.5)
+        costs.add(0, 'sync', 'commcarehq__users', 'GET', 0.25)
+        costs.add(0, 'export', 'commcarehq', 'GET', 0.125)
+
+        metrics = dict(((name, attrs.get('task'), attrs.get('duration')), value)
+                       for name, timestamp, value, attrs in costs.flush())
+        self.assertEqual(metrics, {
+            ('couch.cost.request_seconds', 'build_app', None): 40,
+            ('couch.cost.requests', 'build_app', None): 2,
+            ('couch.cost.request_seconds', '', None): 1.0,
+            ('couch.cost.requests', '', None): 2,
+            ('couch.cost.request_seconds', 'other', None): 0.375,
+            ('couch.cost.requests', 'other', None): 2,
+            ('couch.cost.durations', None, 'lt_001s'): 4,
+            ('couch.cost.durations', None, 'lt_120s'): 1,
+            ('couch.cost.durations', None, 'lt_020s'): 1,
+        })
+
+    def test_parse_with_cost(self):
+        self.assertEqual(len(parse_couch_logs_with_cost(logging, NO_URL_TASK)), 2)
+        later = NO_URL_TASK.replace('18:32:03', '18:33:03')
+        metrics = parse_couch_logs_with_cost(logging, later)
+        self.assertEqual(metrics[2], ('couch.cost.request_seconds', 1446316320, 0.191515, {
+            'metric_type': 'counter',
+            'task': 'corehq.apps.tasks.build_app',
+            'database': 'commcarehq',
+            'http_method': 'PUT',
+        }))
+        self.assertIsNone(parse_couch_logs_with_cost(logging, BORKED))
@@ -0,0 +1,147 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from backfill import ProcessedLedger
+from ingestion import IngestionScheduler
+from nginx.errors import parse_nginx_errors
+from nginx.timings import parse_logs
+
+logging.basicConfig(level=logging.DEBUG)
+
+NGINX_LINE = '[28/Oct/2015:15:18:14 +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 200 0.242\n'
+ERROR_LINE = '2018/01/03 19:04:31 [error] 22548#22548: *16560854 connect() failed (111: Connection refused) while connecting to upstream\n'
+
+
+class TestIngestionScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'ab') as f:
+            f.write(content)
+        return path
+
+    def test_sources_are_read_fairly(self):
+        access = self._write('access.log', NGINX_LINE * 1000)
+        errors = self._write('error.log', ERROR_LINE * 5)
+        scheduler = IngestionScheduler(logging, max_queue=100000)
+        nginx = scheduler.register('nginx', access, parse_logs, chunk_lines=10)
+        nginx_errors = scheduler.register('nginx_errors', errors, parse_nginx_errors, chunk_lines=10)
+
+        scheduler.run_once()
+
+        self.assertEqual(nginx.lines_read, 10)
+        self.assertEqual(nginx_errors.lines_read, 5)
+        self.assertEqual(len(scheduler.drain()), 10 * 3 + 5)
+
+    def test_backpressure(self):
+        access = self._write('access.log', NGINX_LINE * 100)
+        scheduler = IngestionScheduler(logging, max_queue=30)
+        nginx = scheduler.register('nginx', access, parse_logs, chunk_lines=10)
+
+        scheduler.run_once()
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 10)
+        self.assertTrue(scheduler.is_full())
+
+        scheduler.drain()
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 20)
+
+    def test_run_applies_backpressure(self):
+        access = self._write('access.log', NGINX_LINE * 100)
+        scheduler = IngestionScheduler(logging, max_queue=30)
+        nginx = scheduler.register('nginx', access, parse_logs, chunk_lines=10)
+        batches = []
+        rounds = iter(range(3))
+
+        scheduler.run(lambda metrics: batches.append(len(metrics)), idle_sleep=0,
+                      should_stop=lambda: next(rounds, None) is None, max_batch=10)
+
+        self.assertEqual(batches, [10, 10, 10])
+        # the third round found the queue full and read nothing
+        self.assertEqual(nginx.lines_read, 20)
+        scheduler.close()
+
+    def test_partial_line_is_not_read(self):
+        access = self._write('access.log', NGINX_LINE + NGINX_LINE.rstrip('\n'))
+        scheduler = IngestionScheduler(logging)
+        nginx = scheduler.register('nginx', access, parse_logs)
+
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 1)
+
+        self._write('access.log', '\n')
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 2)
+
+    def test_truncated_file_is_read_from_start(self):
+        access = self._write('access.log', NGINX_LINE * 3)
+        scheduler = IngestionScheduler(logging)
+        nginx = scheduler.register('nginx', access, parse_logs)
+        scheduler.run_once()
+
+        with open(access, 'wb') as f:
+            f.write(NGINX_LINE)
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 4)
+
+    def test_renamed_file_is_finished_then_new_file_read(self):
+        access = self._write('access.log', NGINX_LINE * 3)
+        scheduler = IngestionScheduler(logging)
+        nginx = scheduler.register('nginx', access, parse_logs)
+        scheduler.run_once()
+
+        # lines written to the old file before rotation are still read
+        self._write('access.log', NGINX_LINE * 2)
+        os.rename(access, os.path.join(self.dir, 'access.log.1'))
+        self._write('access.log', NGINX_LINE * 4)
+        self.assertEqual(nginx.lag_bytes(), len(NGINX_LINE) * 6)
+
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 5)
+        self.assertEqual(nginx.lag_bytes(), len(NGINX_LINE) * 4)
+
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 9)
+        self.assertEqual(nginx.lag_bytes(), 0)
+        scheduler.close()
+
+    def test_source_shares_ledger_with_backfill(self):
+        access = self._write('access.log', NGINX_LINE * 3)
+        ledger_path = os.path.join(self.dir, 'ledger.json')
+        scheduler = IngestionScheduler(logging)
+        nginx = scheduler.register('nginx', access, parse_logs, chunk_lines=2, ledger=ProcessedLedger(ledger_path))
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 2)
+        self.assertEqual(nginx.lag_bytes(), len(NGINX_LINE))
+
+        # the line left in the rotated file is read by the backfill, not by the live source
+        os.rename(access, os.path.join(self.dir, 'access.log.1'))
+        self._write('access.log', ERROR_LINE * 2)
+        backfill = ProcessedLedger(ledger_path)
+        self.assertEqual(len(list(backfill.new_lines(os.path.join(self.dir, 'access.log.1')))), 1)
+
+        scheduler.run_once()
+        self.assertEqual(nginx.lines_read, 4)
+        self.assertEqual(list(backfill.new_lines(access)), [])
+
+    def test_lag_metrics(self):
+        access = self._write('access.log', NGINX_LINE * 20)
+        scheduler = IngestionScheduler(logging, clock=lambda: 1446045500)
+        scheduler.register('nginx', access, parse_logs, chunk_lines=5)
+        scheduler.run_once()
+
+        metrics = dict(((name, attrs.get('source')), value)
+                       for name, timestamp, value, attrs in scheduler.lag_metrics())
+        self.assertEqual(metrics[('ingestion.lag_bytes', 'nginx')], len(NGINX_LINE) * 15)
+        self.assertEqual(metrics[('ingestion.lag_seconds', 'nginx')], 6)
+        self.assertEqual(metrics[('ingestion.queue_size', None)], 15)
+        scheduler.close()
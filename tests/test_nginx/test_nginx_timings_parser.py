@@ -1,7 +1,8 @@
 import logging
 import unittest
 import datetime
-from nginx.timings import parse_logs, _get_url_group, _sanitize_url, URL_PATTERN_GROUPS
+from nginx import timings
+from nginx.timings import parse_logs, _get_url_group, _sanitize_url, _parse_line, URL_PATTERN_GROUPS, DomainRollup, ErrorBudgetAccumulator, parse_logs_with_error_budget
 from nose_parameterized import parameterized
 from parsing_utils import UnixTimestampTestMixin
 
@@ -190,3 +191,126 @@ class TestNginxTimingsParser(UnixTimestampTestMixin, unittest.TestCase):
         self.assertEqual(count, 0.001)
         self.assertEqual(attrs['status_code'], '400')
         self.assertEqual(attrs['http_method'], 'GET')
+
+
+class TestDomainRollup(unittest.TestCase):
+
+    def _line(self, second, domain, request_time):
+        return '[28/Oct/2015:15:18:{:02d} +0000] GET /a/{}/api/case/ HTTP/1.1 200 {}'.format(second, domain, request_time)
+
+    def test_top_domains_and_other(self):
+        rollup = DomainRollup(interval=60, top_n=2, capacity=4)
+        lines = []
+        for i in range(30):
+            lines.append(self._line(0, 'busy', 2))
+            lines.append(self._line(1, 'slow', 5))
+        for i in range(50):
+            lines.append(self._line(2, 'tail-{}'.format(i), 1))
+        lines.append(self._line(3, '', 1).replace('/a//api', '/home'))
+
+        for line in lines:
+            details = _parse_line(line)
+            self.assertEqual(rollup.add(details.timestamp, details), [])
+        self.assertEqual(len(rollup._domains), 4)
+
+        metrics = dict(((name, attrs['domain']), value) for name, timestamp, value, attrs in rollup.flush())
+        self.assertEqual(metrics, {
+            ('nginx.domain.requests', 'busy'): 30,
+            ('nginx.domain.request_time', 'busy'): 60.0,
+            ('nginx.domain.requests', 'slow'): 30,
+            ('nginx.domain.request_time', 'slow'): 150.0,
+            ('nginx.domain.requests', 'other'): 50,
+            ('nginx.domain.request_time', 'other'): 50.0,
+        })
+
+    def test_flushed_on_next_interval(self):
+        rollup = DomainRollup(interval=60)
+        first = _parse_line(API)
+        rollup.add(first.timestamp, first)
+        rollup.add(first.timestamp, first)
+
+        later = _parse_line(API.replace('15:18:14', '15:19:14'))
+        metrics = rollup.add(later.timestamp, later)
+        self.assertEqual(metrics[0], ('nginx.domain.requests', 1446045480, 2, {'metric_type': 'counter', 'domain': 'uth-rhd'}))
+
+
+class TestErrorBudgetAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        # parse_logs_with_error_budget accumulates into the module-level ERROR_BUDGET
+        self._error_budget = timings.ERROR_BUDGET
+        timings.ERROR_BUDGET = ErrorBudgetAccumulator()
+
+    def tearDown(self):
+        timings.ERROR_BUDGET = self._error_budget
+
+    def _metrics(self, metrics):
+        return dict(((name, attrs['url_group'], attrs.get('status_class') or attrs.get('window')), value)
+                    for name, timestamp, value, attrs in metrics)
+
+    def test_error_ratio_and_burn_rate(self):
+        budget = ErrorBudgetAccumulator(interval=300, targets={'api': 0.99})
+        for i in range(90):
+            budget.add(0, 'api', '200')
+        for i in range(5):
+            budget.add(0, 'api', '404')
+        for i in range(5):
+            budget.add(0, 'api', '502')
+        budget.add(0, 'receiver', '200')
+
+        metrics = self._metrics(budget.flush())
+        expected = {
+            ('nginx.error_ratio', 'api', '4xx'): 0.05,
+            ('nginx.error_ratio', 'api', '5xx'): 0.05,
+            ('nginx.slo.burn_rate', 'api', '5m'): 5.0,
+            ('nginx.slo.burn_rate', 'api', '1h'): 5.0,
+            ('nginx.error_ratio', 'receiver', '4xx'): 0,
+            ('nginx.error_ratio', 'receiver', '5xx'): 0,
+            ('nginx.slo.burn_rate', 'receiver', '5m'): 0,
+            ('nginx.slo.burn_rate', 'receiver', '1h'): 0,
+        }
+        self.assertEqual(set(metrics), set(expected))
+        for key, value in expected.items():
+            self.assertAlmostEqual(metrics[key], value)
+
+    def test_long_window_includes_earlier_buckets(self):
+        budget = ErrorBudgetAccumulator(interval=300, default_target=0.9)
+        for i in range(10):
+            budget.add(0, 'api', '500')
+        for i in range(10):
+            budget.add(300, 'api', '200')
+        metrics = self._metrics(budget.add(600, 'api', '200'))
+
+        self.assertEqual(metrics[('nginx.slo.burn_rate', 'api', '5m')], 0)
+        self.assertAlmostEqual(metrics[('nginx.slo.burn_rate', 'api', '1h')], 5)
+
+    def test_memory_is_bounded(self):
+        budget = ErrorBudgetAccumulator(interval=300)
+        for bucket in range(100):
+            budget.add(bucket * 300, 'api', '200')
+        self.assertEqual(len(budget._history['api']), 12)
+
+        budget.add(100 * 300 + 3600, 'receiver', '200')
+        budget.flush()
+        self.assertNotIn('api', budget._history)
+
+    @parameterized.expand([
+        ({'api': 1.0}, 0.999),
+        ({}, 1),
+        ({'api': -0.5}, 0.999),
+    ])
+    def test_invalid_target(self, targets, default_target):
+        with self.assertRaises(ValueError):
+            ErrorBudgetAccumulator(targets=targets, default_target=default_target)
+
+    def test_set_invalid_target(self):
+        budget = ErrorBudgetAccumulator()
+        with self.assertRaises(ValueError):
+            budget.set_target('api', 1.0)
+        self.assertNotIn('api', budget.targets)
+
+    def test_parse_with_error_budget(self):
+        self.assertEqual(len(parse_logs_with_error_budget(logging, API)), 3)
+        later = API.replace('15:18:14', '15:25:14')
+        metrics = self._metrics(parse_logs_with_error_budget(logging, later)[3:])
+        self.assertEqual(metrics[('nginx.error_ratio', 'api', '4xx')], 1)
@@ -1,6 +1,6 @@
 import unittest
 import datetime
-from parsing_utils import get_unix_timestamp
+from parsing_utils import LazyRegex, get_unix_timestamp
 
 
 class TestParsingUtils(unittest.TestCase):
@@ -9,3 +9,10 @@ class TestParsingUtils(unittest.TestCase):
 
     def test_get_unix_timestamp_on_epoch(self):
         self.assertEqual(get_unix_timestamp(datetime.datetime(1970, 1, 1)), 0)
+
+    def test_lazy_regex(self):
+        regex = LazyRegex(r'/a/(?P<domain>[0-9a-z-]+)')
+        self.assertNotIn('search', vars(regex))
+        self.assertEqual(regex.search('/a/my-domain/api/').group('domain'), 'my-domain')
+        self.assertIn('search', vars(regex))
+        self.assertEqual(regex.sub('/a/*', '/a/my-domain/api/'), '/a/*/api/')
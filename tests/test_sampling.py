@@ -0,0 +1,151 @@
+import logging
+import random
+import unittest
+from couch.parsers import is_priority_line as is_priority_couch_line, parse_couch_logs
+from nginx import timings
+from nginx.timings import (DomainRollup, ErrorBudgetAccumulator, is_priority_line, parse_logs,
+                           parse_logs_with_domain_rollup, parse_logs_with_error_budget)
+from nose_parameterized import parameterized
+from sampling import AdaptiveSampler, sampled_parser
+
+logging.basicConfig(level=logging.DEBUG)
+
+FAST = '[28/Oct/2015:15:18:14 +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 200 0.242'
+SERVER_ERROR = '[28/Oct/2015:15:18:14 +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 502 0.242'
+SLOW = '[28/Oct/2015:15:18:14 +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 200 25.2 -'
+# in the next error budget bucket and domain rollup interval
+LATER_FAST = FAST.replace('15:18:14', '15:25:14')
+COUCH_FAST = '2017-05-04 12:20:21,416 [:icds-cas] /a/icds-cas/receiver/secure/768932dcb27f35c63cdbb830c202c727/ commcarehq__users GET 200 None _design/users/_view/by_username 0:00:00.004401'
+COUCH_SLOW = '2017-05-04 12:20:21,416 [:icds-cas] /a/icds-cas/receiver/secure/768932dcb27f35c63cdbb830c202c727/ commcarehq__users GET 200 None _design/users/_view/by_username 0:02:00.004401'
+COUCH_ERROR = '2015-10-31 18:32:03,963 [:mvp-pampaida] /a/mvp-pampaida/receiver/630916e49084b142c0a5a69c3a52b9b3/ PUT 500 d3abf611f2acdc7b4c32f7ebf4982a88 0:00:00.191515'
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _request_count(metrics):
+    return sum(value for name, timestamp, value, attrs in metrics if name in ('nginx.requests', 'couch.requests'))
+
+
+class TestAdaptiveSampler(unittest.TestCase):
+
+    @parameterized.expand([
+        (FAST, False),
+        (SERVER_ERROR, True),
+        (SLOW, True),
+        ('Borked', False),
+    ])
+    def test_nginx_priority_line(self, line, expected):
+        self.assertEqual(bool(is_priority_line(line)), expected)
+
+    @parameterized.expand([
+        (COUCH_FAST, False),
+        (COUCH_SLOW, True),
+        (COUCH_ERROR, True),
+        ('Borked', False),
+    ])
+    def test_couch_priority_line(self, line, expected):
+        self.assertEqual(is_priority_couch_line(line), expected)
+
+    def test_no_sampling_under_budget(self):
+        clock = FakeClock()
+        parse = sampled_parser(parse_logs, AdaptiveSampler(100, interval=1, clock=clock), is_priority_line)
+        metrics = []
+        for second in range(5):
+            clock.now = second
+            for i in range(50):
+                metrics.extend(parse(logging, FAST))
+        self.assertEqual(_request_count(metrics), 250)
+
+    def test_totals_converge_under_load(self):
+        clock = FakeClock()
+        sampler = AdaptiveSampler(100, interval=1, clock=clock, rng=random.Random(42))
+        parse = sampled_parser(parse_logs, sampler, is_priority_line)
+
+        metrics = []
+        parsed = 0
+        lines = 0
+        for second in range(100):
+            clock.now = second
+            for i in range(2000):
+                result = parse(logging, FAST)
+                lines += 1
+                if result:
+                    parsed += 1
+                    metrics.extend(result)
+
+        self.assertAlmostEqual(sampler.rate, 0.05)
+        self.assertLess(parsed, lines * 0.1)
+        self.assertAlmostEqual(_request_count(metrics) / lines, 1, delta=0.02)
+
+    def test_priority_lines_always_kept_unscaled(self):
+        clock = FakeClock()
+        sampler = AdaptiveSampler(10, interval=1, clock=clock, rng=random.Random(42))
+        parse = sampled_parser(parse_logs, sampler, is_priority_line)
+        for i in range(1000):
+            parse(logging, FAST)
+        clock.now = 1
+
+        metrics = []
+        for i in range(100):
+            metrics.extend(parse(logging, SERVER_ERROR))
+        self.assertLess(sampler.rate, 1)
+        self.assertEqual(_request_count(metrics), 100)
+
+    def test_couch_counters_scaled(self):
+        clock = FakeClock()
+        sampler = AdaptiveSampler(10, interval=1, clock=clock, rng=random.Random(7))
+        parse = sampled_parser(parse_couch_logs, sampler, is_priority_couch_line)
+        for i in range(100):
+            parse(logging, COUCH_FAST)
+        clock.now = 1
+
+        metrics = []
+        for i in range(10000):
+            metrics.extend(parse(logging, COUCH_FAST) or [])
+        timings = [value for name, timestamp, value, attrs in metrics if name == 'couch.timings']
+        self.assertEqual(set(timings), {0.004401})
+        self.assertAlmostEqual(_request_count(metrics) / 10000, 1, delta=0.1)
+
+
+class TestSampledAccumulators(unittest.TestCase):
+
+    def setUp(self):
+        self._error_budget = timings.ERROR_BUDGET
+        self._domain_rollup = timings.DOMAIN_ROLLUP
+        timings.ERROR_BUDGET = ErrorBudgetAccumulator()
+        timings.DOMAIN_ROLLUP = DomainRollup()
+
+    def tearDown(self):
+        timings.ERROR_BUDGET = self._error_budget
+        timings.DOMAIN_ROLLUP = self._domain_rollup
+
+    def _run(self, parse_func, lines=20000):
+        """Feed 0.5% server errors through a sampled ``parse_func``, then return what the next window flushes"""
+        clock = FakeClock()
+        sampler = AdaptiveSampler(100, interval=1, clock=clock, rng=random.Random(42))
+        parse = sampled_parser(parse_func, sampler, is_priority_line, aggregating=True)
+        for i in range(lines):
+            clock.now = i // 1000
+            parse(logging, SERVER_ERROR if i % 200 == 0 else FAST)
+        self.assertLess(sampler.rate, 0.2)
+
+        # the line closing the window is sampled too, so its own counters are scaled
+        result = None
+        while not result:
+            result = parse(logging, LATER_FAST)
+        return result[3:]
+
+    def test_burn_rate_is_not_skewed_by_priority_lines(self):
+        metrics = dict(((name, attrs.get('window')), value) for name, timestamp, value, attrs in self._run(parse_logs_with_error_budget))
+        # 0.5% server errors against a 0.1% budget
+        self.assertAlmostEqual(metrics[('nginx.slo.burn_rate', '5m')], 5, delta=0.5)
+
+    def test_flushed_counters_are_not_rescaled(self):
+        metrics = dict(((name, attrs['domain']), value) for name, timestamp, value, attrs in self._run(parse_logs_with_domain_rollup))
+        self.assertAlmostEqual(metrics[('nginx.domain.requests', 'uth-rhd')] / 20000, 1, delta=0.05)
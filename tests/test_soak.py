@@ -0,0 +1,62 @@
+import itertools
+import unittest
+from benchmarks.soak import Sample, check_drift, run_soak, synthetic_lines
+
+
+def _sample(rss_mb, mean_latency, log_records=0):
+    return Sample(elapsed=0, rss_bytes=rss_mb * 1024 * 1024, lines=0, lines_per_second=0,
+                  mean_latency=mean_latency, log_records=log_records, top_allocators=[])
+
+
+class FakeClock(object):
+    """Advances a little on every reading, and by the requested amount on sleep"""
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        self.now += 0.0001
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestSoak(unittest.TestCase):
+
+    def test_short_run(self):
+        streams = dict((source, synthetic_lines(source)) for source in ('nginx', 'nginx_errors', 'couch'))
+        samples = run_soak(streams, duration=0.5, sample_interval=0.1)
+
+        self.assertGreaterEqual(len(samples), 3)
+        self.assertTrue(all(sample.lines_per_second > 0 for sample in samples))
+        self.assertTrue(all(sample.top_allocators for sample in samples))
+        self.assertEqual(check_drift(samples, max_latency_growth=10, max_log_records_per_line=0.1), [])
+
+    def test_pacing_per_source(self):
+        # a recorded 2026 log, 10 log seconds per line, replayed in a loop next to 2015 synthetic lines
+        recorded = itertools.cycle([
+            '[19/Oct/2026:10:00:{:02d} +0000] GET /a/uth-rhd/api/case/ HTTP/1.1 200 0.242'.format(second)
+            for second in (0, 10, 20)
+        ])
+        streams = {'nginx': recorded, 'couch': synthetic_lines('couch')}
+        clock = FakeClock()
+        run_soak(streams, duration=5, speedup=50, sample_interval=1, clock=clock, sleep=clock.sleep)
+
+        self.assertLess(clock.now, 5.1)
+        self.assertLessEqual(max(clock.sleeps), 5)
+        # pacing keeps going after the recorded log wraps: about one line per 0.2s
+        self.assertGreater(sum(1 for seconds in clock.sleeps if seconds > 0.1), 15)
+
+    def test_no_drift(self):
+        samples = [_sample(100, 0.001), _sample(20, 0.00005), _sample(25, 0.00006)]
+        self.assertEqual(check_drift(samples), [])
+
+    def test_drift(self):
+        samples = [_sample(100, 0.001), _sample(20, 0.00005), _sample(200, 0.0001, log_records=0.5)]
+        failures = check_drift(samples)
+        self.assertEqual(len(failures), 3)
+
+    def test_not_enough_samples(self):
+        self.assertEqual(len(check_drift([_sample(20, 0.00005)])), 1)
@@ -0,0 +1,78 @@
+import unittest
+from streaming import SpaceSaving, WindowedAccumulator
+
+
+class CountingAccumulator(WindowedAccumulator):
+    def __init__(self, interval):
+        super(CountingAccumulator, self).__init__(interval)
+        self.count = 0
+
+    def observe(self, value):
+        self.count += value
+
+    def emit(self, timestamp):
+        return [('count', timestamp, self.count, {'metric_type': 'counter'})]
+
+    def reset(self):
+        self.count = 0
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def test_heavy_hitters_survive_long_tail(self):
+        counter = SpaceSaving(10)
+        for i in range(10000):
+            counter.add('heavy-{}'.format(i % 3), 1, (1,))
+            counter.add('tail-{}'.format(i), 1, (1,))
+
+        self.assertEqual(len(counter), 10)
+        top = counter.top(3)
+        self.assertEqual(sorted(key for key, values in top), ['heavy-0', 'heavy-1', 'heavy-2'])
+        tracked = sum(values[0] for key, values in top)
+        self.assertEqual(tracked + counter.remainder(3)[0], 20000)
+
+    def test_values_are_exact_when_under_capacity(self):
+        counter = SpaceSaving(10, width=2)
+        counter.add('a', 1, (1, 0.5))
+        counter.add('a', 1, (1, 1.5))
+        counter.add('b', 1, (1, 3))
+        self.assertEqual(counter.top(1), [('a', [2, 2.0])])
+        self.assertEqual(counter.remainder(1), [1, 3])
+
+        counter.clear()
+        self.assertEqual(counter.top(5), [])
+        self.assertEqual(counter.remainder(5), [0, 0])
+
+    def test_evicts_lightest_after_weights_change(self):
+        counter = SpaceSaving(3)
+        counter.add('a', 1, (1,))
+        counter.add('b', 1, (1,))
+        counter.add('c', 1, (1,))
+        # 'a' and 'b' now outweigh their stale heap entries
+        counter.add('a', 5, (1,))
+        counter.add('b', 3, (1,))
+        counter.add('d', 1, (1,))
+
+        self.assertEqual(sorted(key for key, values in counter.top(3)), ['a', 'b', 'd'])
+        self.assertEqual(len(counter._heap), 3)
+
+    def test_split_matches_totals(self):
+        counter = SpaceSaving(20, width=2)
+        for i in range(5000):
+            counter.add(i % 7 if i % 2 else 'tail-{}'.format(i), 1, (1, 0.5))
+
+        top, remainder = counter.split(7)
+        self.assertEqual(sorted(key for key, values in top), list(range(7)))
+        self.assertEqual(sum(values[0] for key, values in top) + remainder[0], 5000)
+        self.assertEqual(len(counter._heap), len(counter))
+
+
+class TestWindowedAccumulator(unittest.TestCase):
+
+    def test_flushes_on_window_change(self):
+        accumulator = CountingAccumulator(60)
+        self.assertEqual(accumulator.add(120, 1), [])
+        self.assertEqual(accumulator.add(179, 2), [])
+        self.assertEqual(accumulator.add(150, 3), [])
+        self.assertEqual(accumulator.add(185, 1), [('count', 120, 6, {'metric_type': 'counter'})])
+        self.assertEqual(accumulator.flush(), [('count', 180, 1, {'metric_type': 'counter'})])